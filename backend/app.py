@@ -215,7 +215,8 @@ def admin_create_stock():
                           volume = EXCLUDED.volume,
                           sector = EXCLUDED.sector,
                           is_listed = EXCLUDED.is_listed,
-                          created_by = EXCLUDED.created_by;
+                          created_by = EXCLUDED.created_by,
+                          updated_at = now();
                 """, (ticker, company_name, current_price, volume, sector, is_listed, user["username"]))
         conn.close()
         return jsonify({
@@ -1,8 +1,14 @@
 import time, jwt, os
+from datetime import datetime, timedelta, timezone
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 import socket
+import threading
+import db
+import ratelimit
+import matching
+import search
 
 #this is a secure way to securely transmit info as JSON
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
@@ -31,40 +37,23 @@ except Exception:
     psycopg2 = None
 
 # ---- DB Helpers ----
-def get_db_connection():
-    import psycopg2
-    conn = psycopg2.connect(
-        host=os.getenv("DATABASE_HOST"),
-        port=os.getenv("DATABASE_PORT", "5432"),
-        dbname=os.getenv("DATABASE_NAME"),
-        user=os.getenv("DATABASE_USER"),
-        password=os.getenv("DATABASE_PASSWORD")
-    )
-    return conn
-
-def db_get_user_by_username(username: str):
+# All connections come from db.py (DATABASE_URL or DATABASE_*), pooled.
+def db_get_user_by_username(username: str, readonly: bool = False):
+    """readonly=True allows the lookup to be served by a replica."""
     username = (username or "").strip()
     if not username:
         return None
-    conn = get_db_connection()
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT id, username, email, full_name, password_hash, role, created_at
-                    FROM users
-                    WHERE username = %s
-                """, (username,))
-                row = cur.fetchone()
-                if not row:
-                    return None
-                return {
-                    "id": row[0], "username": row[1], "email": row[2],
-                    "full_name": row[3], "password_hash": row[4],
-                    "role": row[5], "created_at": row[6]
-                }
-    finally:
-        conn.close()
+    row = db.execute("user_by_username", (username,), readonly=readonly, user_key=username)
+    if not row and readonly:
+        # A replica may not have replayed a just-committed registration yet
+        row = db.execute("user_by_username", (username,))
+    if not row:
+        return None
+    return {
+        "id": row[0], "username": row[1], "email": row[2],
+        "full_name": row[3], "password_hash": row[4],
+        "role": row[5], "created_at": row[6]
+    }
 
 def db_create_user(full_name: str, username: str, email: str, password: str, role: str = "user"):
     username = (username or "").strip()
@@ -76,9 +65,8 @@ def db_create_user(full_name: str, username: str, email: str, password: str, rol
 
     pw_hash = generate_password_hash(password)
 
-    conn = get_db_connection()
     try:
-        with conn:
+        with db.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO users (username, email, full_name, password_hash, role)
@@ -97,53 +85,33 @@ def db_create_user(full_name: str, username: str, email: str, password: str, rol
         if "users_email_key" in msg:
             raise ValueError("Email already exists")
         raise
-    finally:
-        conn.close()
 
 def db_deposit(user_id: str, amount: float) -> float:
     """Add to cash_balance; returns new balance."""
-    import psycopg2
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE users
-                   SET cash_balance = cash_balance + %s
-                 WHERE id = %s
-             RETURNING cash_balance;
-            """, (amount, user_id))
-            row = cur.fetchone()
-            if not row:
-                raise ValueError("User not found")
-            return float(row[0])
+    row = db.execute("cash_deposit", (user_id, amount))
+    if not row:
+        raise ValueError("User not found")
+    return float(row[0])
 
 def db_withdraw(user_id: str, amount: float) -> float:
     """
     Subtract from cash_balance; returns new balance.
     Fails if balance would go negative.
     """
-    import psycopg2
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE users
-                   SET cash_balance = cash_balance - %s
-                 WHERE id = %s
-                   AND cash_balance >= %s
-             RETURNING cash_balance;
-            """, (amount, user_id, amount))
-            row = cur.fetchone()
-            if not row:
-                # Either user not found or insufficient funds
-                raise ValueError("Insufficient funds")
-            return float(row[0])
+    row = db.execute("cash_withdraw", (user_id, amount))
+    if not row:
+        # Either user not found or insufficient funds
+        raise ValueError("Insufficient funds")
+    return float(row[0])
 
 app = Flask(__name__)
 
 # Allow your Amplify frontend (set to your exact Amplify URL)
 AMPLIFY_ORIGIN = os.getenv("AMPLIFY_ORIGIN", "https://main.d2bmkzvarvu1na.amplifyapp.com")
-CORS(app, resources={r"/*": {"origins": [AMPLIFY_ORIGIN, "http://localhost:5173", "http://127.0.0.1:5173"]}}, supports_credentials=True, allow_headers=["Content-Type", "Authorization"], expose_headers=["Content-Type", "Authorization"], methods=["GET>
+CORS(app, resources={r"/*": {"origins": [AMPLIFY_ORIGIN, "http://localhost:5173", "http://127.0.0.1:5173"]}}, supports_credentials=True, allow_headers=["Content-Type", "Authorization"], expose_headers=["Content-Type", "Authorization", "Retry-After"], methods=["GET", "POST", "OPTIONS"])
+
+# Per-user/per-IP token buckets and overload shedding (see ratelimit.py for env knobs)
+ratelimit.init_app(app, user_key=lambda: parse_token(request.headers.get("Authorization")))
 
 # ---- Demo in-memory "DB" ----
 USERS = {}      # username -> {password, full_name, email, role}
@@ -173,14 +141,7 @@ def dbcheck():
     if psycopg2 is None:
         return jsonify(ok=False, error="psycopg2 not installed"), 500
     try:
-        conn = psycopg2.connect(
-            host=os.getenv("DATABASE_HOST"),
-            port=os.getenv("DATABASE_PORT", "5432"),
-            dbname=os.getenv("DATABASE_NAME", "postgres"),
-            user=os.getenv("DATABASE_USER"),
-            password=os.getenv("DATABASE_PASSWORD"),
-            connect_timeout=3,
-        )
+        conn = psycopg2.connect(connect_timeout=3, **db.connect_kwargs())
         with conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT 1;")
@@ -189,6 +150,25 @@ def dbcheck():
     except Exception as e:
         return jsonify(ok=False, error=str(e)), 500
 
+def admin_error():
+    """401/403 response unless the caller is an admin; None if they are."""
+    user = get_current_user()
+    if not user:
+        return jsonify({"detail": "Not Authenticated"}), 401
+    if (user.get("role") or "").strip().lower() != "admin":
+        return jsonify({"detail": "Forbidden"}), 403
+    return None
+
+@app.route("/dbcheck/statements")
+def dbcheck_statements():
+    """Per-statement call counts and timings for the prepared hot paths (admin only)."""
+    return admin_error() or jsonify(db.statement_stats())
+
+@app.route("/dbcheck/pool")
+def dbcheck_pool():
+    """Connections in use/idle per pool in the worker that answers (admin only)."""
+    return admin_error() or jsonify(db.pool_stats())
+
 # ---- Auth helpers ----
 def get_current_user():
     """Extract current user from Authorization: Bearer <token>.
@@ -206,7 +186,7 @@ def get_current_user():
         username = payload.get("sub")
         if not username:
             return None
-        u = db_get_user_by_username(username)
+        u = db_get_user_by_username(username, readonly=True)
         if not u:
             return None
         return {
@@ -219,7 +199,7 @@ def get_current_user():
     except Exception:
         # Fallback: legacy demo token == username
         username = raw
-        u = db_get_user_by_username(username)
+        u = db_get_user_by_username(username, readonly=True)
         if not u:
             return None
         return {
@@ -295,6 +275,7 @@ def register():
 
     try:
         user =db_create_user(full_name, username, email, password, role="user")
+        db.pin_primary(user["username"])
         token = make_token(user["username"])
         return jsonify({"access_token": token, "token_type": "bearer"}), 201
     except ValueError as ve:
@@ -324,15 +305,8 @@ def account():
     if not user:
         return jsonify({"detail": "Not authenticated"}), 401
     try:
-        conn = get_db_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT cash_balance FROM users WHERE id = %s LIMIT 1;",
-                    (user["id"],)
-                )
-                row = cur.fetchone()
-                balance = float(row[0]) if row and row[0] is not None else 0.0
+        row = db.execute("cash_balance", (user["id"],), readonly=True, user_key=user["username"])
+        balance = float(row[0]) if row and row[0] is not None else 0.0
         return jsonify({
             "username":  user["username"],
             "full_name": user["full_name"],
@@ -360,6 +334,7 @@ def cash_deposit():
 
     try:
         new_balance = db_deposit(user["id"], amount)  # <-- use users-table helper
+        db.pin_primary(user["username"])
         return jsonify({"ok": True, "new_balance": new_balance})
     except Exception as e:
         return jsonify({"detail": str(e)}), 500
@@ -381,6 +356,7 @@ def cash_withdraw():
 
     try:
         new_balance = db_withdraw(user["id"], amount)  # <-- use users-table helper
+        db.pin_primary(user["username"])
         return jsonify({"ok": True, "new_balance": new_balance})
     except ValueError as ve:
         # raised by db_withdraw on insufficient funds
@@ -416,8 +392,7 @@ def admin_create_stock():
         return jsonify({"detail": "Ticker, company name, and positive current price required"}), 400
 
     try:
-        conn = get_db_connection()
-        with conn:
+        with db.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO stocks (ticker, company_name, current_price, volume, sector, is_listed, created_by)
@@ -428,11 +403,19 @@ def admin_create_stock():
                           volume = COALESCE(EXCLUDED.volume, stocks.volume),
                           sector = COALESCE(EXCLUDED.sector, stocks.sector),
                           is_listed = EXCLUDED.is_listed,
-                          created_by = EXCLUDED.created_by
-                    RETURNING ticker, company_name, current_price, volume, sector, is_listed;
+                          created_by = EXCLUDED.created_by,
+                          updated_at = now()
+                    RETURNING ticker, company_name, current_price, volume, sector, is_listed, updated_at;
                 """, (ticker, company_name, float(current_price), volume, sector, is_listed, user["id"]))
                 t = cur.fetchone()
 
+        # This worker sees the change now; the others pick it up on their next poll
+        if _search_index is not None:
+            _search_index.upsert({
+                "ticker": t[0], "company_name": t[1], "current_price": t[2],
+                "sector": t[4], "is_listed": t[5], "updated_at": t[6],
+            })
+
         return jsonify({
             "ticker": t[0],
             "company_name": t[1],
@@ -453,18 +436,7 @@ def list_tickers():
     { "ticker":"ACME", "company_name":"Acme Corp", "current_price": 99.99 }
     """
     try:
-        conn = get_db_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT ticker, company_name, current_price
-                    FROM stocks
-                    WHERE is_listed = TRUE
-                    ORDER BY ticker ASC
-                    LIMIT 500
-                """)
-                rows = cur.fetchall()
-        conn.close()
+        rows = db.execute("list_tickers", fetch="all", readonly=True)
 
         data = [
             {"ticker": r[0], "company_name": r[1], "current_price": float(r[2])}
@@ -474,22 +446,81 @@ def list_tickers():
     except Exception as e:
         return jsonify({"detail": str(e)}), 500
 
+# ---- Search ----
+# Per-worker index over listed stocks. The first search loads it in full;
+# after that, every SEARCH_REFRESH_SECONDS a background thread applies only
+# the rows whose updated_at moved (search_changes), so upserts made through
+# any worker show up everywhere without a rebuild. Each poll looks back
+# SEARCH_CHANGE_OVERLAP_SECONDS before the newest version seen, to catch
+# transactions that committed after a later timestamp was already read;
+# re-applying a row is harmless and older versions are ignored. Stocks are
+# unlisted, never deleted, so changes always arrive as rows.
+_search_index = None
+_search_version = None      # newest updated_at applied to the index
+_search_checked_at = 0.0
+_search_refreshing = threading.Lock()
+
+def _search_row(r):
+    return {"ticker": r[0], "company_name": r[1], "sector": r[2], "current_price": r[3],
+            "is_listed": r[4], "updated_at": r[5]}
+
+def _load_search_index():
+    global _search_index, _search_version, _search_checked_at
+    rows = [_search_row(r) for r in db.execute("search_universe", fetch="all", readonly=True)]
+    index = search.SearchIndex()
+    index.rebuild(rows)
+    _search_version = max((r["updated_at"] for r in rows), default=None)
+    _search_index, _search_checked_at = index, time.time()
+
+def _apply_search_changes():
+    global _search_version, _search_checked_at
+    try:
+        since = _search_version or datetime(1970, 1, 1, tzinfo=timezone.utc)
+        since -= timedelta(seconds=float(os.getenv("SEARCH_CHANGE_OVERLAP_SECONDS", "30")))
+        for r in db.execute("search_changes", (since,), fetch="all", readonly=True):
+            row = _search_row(r)
+            _search_index.upsert(row)
+            if _search_version is None or row["updated_at"] > _search_version:
+                _search_version = row["updated_at"]
+        _search_checked_at = time.time()
+    except Exception:
+        pass  # keep serving what we have; retried on the next search
+    finally:
+        _search_refreshing.release()
+
+def get_search_index():
+    if _search_index is None:
+        _load_search_index()
+    elif time.time() - _search_checked_at > float(os.getenv("SEARCH_REFRESH_SECONDS", "5")):
+        if _search_refreshing.acquire(blocking=False):
+            threading.Thread(target=_apply_search_changes, daemon=True).start()
+    return _search_index
+
+@app.route("/market/search", methods=["GET"])
+def market_search():
+    """
+    Prefix, substring and typo-tolerant search over ticker, company name and sector.
+    Example: /market/search?q=micro&limit=5
+    """
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"detail": "q required"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 10)), 50))
+    except (TypeError, ValueError):
+        limit = 10
+    try:
+        return jsonify(get_search_index().search(q, limit=limit))
+    except Exception as e:
+        return jsonify({"detail": str(e)}), 500
+
 @app.route("/market/tickers/<ticker>", methods=["GET"])
 def get_ticker(ticker):
     ticker = (ticker or "").strip().upper()
     if not ticker:
         return jsonify({"detail": "ticker required"}), 400
     try:
-        conn = get_db_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT ticker, company_name, current_price, volume, sector, is_listed, created_by, created_at
-                    FROM stocks
-                    WHERE ticker = %s
-                """, (ticker,))
-                row = cur.fetchone()
-        conn.close()
+        row = db.execute("ticker_by_symbol", (ticker,), readonly=True)
 
         if not row:
             return jsonify({"detail": "Not found"}), 404
@@ -507,6 +538,120 @@ def get_ticker(ticker):
     except Exception as e:
         return jsonify({"detail": str(e)}), 500
 
+# ---- Trading ----
+# Orders are matched by the sharded engine processes (matching.py), not in
+# this worker; each request waits for the owning shard's acknowledgement.
+# Fills don't move cash yet, so the routes stay off unless ENABLE_TRADING=1
+# (load tests and local runs only).
+_engine = None
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        socket_dir, shards = matching.engine_config()
+        _engine = matching.EngineClient(socket_dir, shards)
+    return _engine
+
+def trading_enabled() -> bool:
+    return os.getenv("ENABLE_TRADING", "").strip().lower() in ("1", "true", "yes")
+
+def order_response(ticker: str, side: str, ack: dict):
+    """Engine ack plus the fields the buy/sell pages show: average fill
+    price, shares filled and their total value."""
+    total = sum(f["price"] * f["quantity"] for f in ack["fills"])
+    return {
+        **ack,
+        "ticker": ticker,
+        "side": side,
+        "price": round(total / ack["filled"], 4) if ack["filled"] else None,
+        "quantity": ack["filled"],
+        "total_value": round(total, 2),
+    }
+
+def place_order(side: str):
+    if not trading_enabled():
+        return jsonify({"detail": "Trading is not available yet"}), 503
+    user = get_current_user()
+    if not user:
+        return jsonify({"detail": "Not Authenticated"}), 401
+
+    body = request.get_json(force=True) or {}
+    ticker = (body.get("ticker") or "").strip().upper()
+    if not ticker:
+        return jsonify({"detail": "ticker required"}), 400
+    if (body.get("side") or side).strip().lower() != side:
+        return jsonify({"detail": f"side must be {side} on /trade/{side}"}), 400
+
+    try:
+        row = db.execute("ticker_by_symbol", (ticker,), readonly=True)
+        if not row or not row[5]:
+            return jsonify({"detail": "Unknown or unlisted ticker"}), 404
+        ack = get_engine().submit({
+            "ticker": ticker,
+            "side": side,
+            "quantity": body.get("quantity"),
+            "limit_price": body.get("limit_price"),
+            "lot_method": body.get("lot_method"),   # sells: fifo (default), lifo or specific
+            "lot_ids": body.get("lot_ids"),
+            "user": user["username"],
+        })
+        if ack["status"] == "cancelled":
+            # Market order with nothing to match against
+            return jsonify({"detail": f"No {'sellers' if side == 'buy' else 'buyers'} for {ticker} right now"}), 409
+        return jsonify(order_response(ticker, side, ack)), (202 if ack["status"] == "open" else 200)
+    except ValueError as ve:
+        return jsonify({"detail": str(ve)}), 400
+    except matching.EngineError as e:
+        return jsonify({"detail": f"Matching engine unavailable: {e}"}), 503
+    except Exception as e:
+        return jsonify({"detail": str(e)}), 500
+
+@app.route("/trade/buy", methods=["POST"])
+def trade_buy():
+    return place_order("buy")
+
+@app.route("/trade/sell", methods=["POST"])
+def trade_sell():
+    return place_order("sell")
+
+# ---- Portfolio (tax lots are kept by the engine shards, see lots.py) ----
+@app.route("/portfolio/holdings", methods=["GET"])
+def portfolio_holdings():
+    user = get_current_user()
+    if not user:
+        return jsonify({"detail": "Not Authenticated"}), 401
+    try:
+        engine = get_engine()
+        summary = engine.summary(user["username"])
+        return jsonify({
+            "positions": summary["positions"],
+            "lots": engine.open_lots(user["username"]),
+        })
+    except matching.EngineError as e:
+        return jsonify({"detail": f"Matching engine unavailable: {e}"}), 503
+    except Exception as e:
+        return jsonify({"detail": str(e)}), 500
+
+@app.route("/portfolio/realized", methods=["GET"])
+def portfolio_realized():
+    """Realized-gain summary plus the most recent per-lot records."""
+    user = get_current_user()
+    if not user:
+        return jsonify({"detail": "Not Authenticated"}), 401
+    try:
+        limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+    except (TypeError, ValueError):
+        limit = 100
+    try:
+        engine = get_engine()
+        summary = engine.summary(user["username"])
+        summary["records"] = engine.realized(user["username"], limit)
+        return jsonify(summary)
+    except matching.EngineError as e:
+        return jsonify({"detail": f"Matching engine unavailable: {e}"}), 503
+    except Exception as e:
+        return jsonify({"detail": str(e)}), 500
+
 if __name__ == "__main__":
     # Only used if you run app.py directly; systemd runs gunicorn
     from os import getenv
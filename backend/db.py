@@ -0,0 +1,400 @@
+import os, time, sqlite3, tempfile, threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Optional: psycopg2 (OK if missing, same as app /dbcheck)
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.pool
+except Exception:
+    psycopg2 = None
+
+# ---- Named statement registry ----
+# Each hot statement is PREPAREd once per pooled connection and then run with
+# EXECUTE <name>(...). `index` is the index the plan is expected to use; the
+# EXPLAIN tests in tests/test_statements.py fail if the planner stops using it.
+Statement = namedtuple("Statement", ["name", "sql", "index"])
+
+STATEMENTS = {s.name: s for s in [
+    Statement("user_by_username", """
+        SELECT id, username, email, full_name, password_hash, role, created_at
+        FROM users
+        WHERE username = $1
+    """, "users_username_key"),
+    Statement("cash_balance", """
+        SELECT cash_balance FROM users WHERE id = $1 LIMIT 1
+    """, "users_pkey"),
+    Statement("cash_deposit", """
+        UPDATE users
+           SET cash_balance = cash_balance + $2
+         WHERE id = $1
+     RETURNING cash_balance
+    """, "users_pkey"),
+    Statement("cash_withdraw", """
+        UPDATE users
+           SET cash_balance = cash_balance - $2
+         WHERE id = $1
+           AND cash_balance >= $2
+     RETURNING cash_balance
+    """, "users_pkey"),
+    Statement("list_tickers", """
+        SELECT ticker, company_name, current_price
+        FROM stocks
+        WHERE is_listed = TRUE
+        ORDER BY ticker ASC
+        LIMIT 500
+    """, "stocks_listed_ticker_idx"),
+    Statement("ticker_by_symbol", """
+        SELECT ticker, company_name, current_price, volume, sector, is_listed, created_by, created_at
+        FROM stocks
+        WHERE ticker = $1
+    """, "stocks_ticker_key"),
+    # Full load for the in-process search index (search.py), via the listed-ticker partial index
+    Statement("search_universe", """
+        SELECT ticker, company_name, sector, current_price, is_listed, updated_at
+        FROM stocks
+        WHERE is_listed = TRUE
+        ORDER BY ticker
+    """, "stocks_listed_ticker_idx"),
+    # Rows changed since a worker's last look (listed or not), applied to its index
+    Statement("search_changes", """
+        SELECT ticker, company_name, sector, current_price, is_listed, updated_at
+        FROM stocks
+        WHERE updated_at > $1
+        ORDER BY updated_at
+    """, "stocks_updated_at_idx"),
+]}
+
+
+PRIMARY = "primary"
+
+def connect_kwargs():
+    """Primary DSN: DATABASE_URL wins (CI sets it); otherwise the DATABASE_* parts."""
+    url = os.getenv("DATABASE_URL")
+    if url:
+        return {"dsn": url}
+    return {
+        "host": os.getenv("DATABASE_HOST"),
+        "port": os.getenv("DATABASE_PORT", "5432"),
+        "dbname": os.getenv("DATABASE_NAME"),
+        "user": os.getenv("DATABASE_USER"),
+        "password": os.getenv("DATABASE_PASSWORD"),
+    }
+
+def replica_dsns():
+    """Comma-separated DATABASE_REPLICA_URLS; empty means primary only."""
+    raw = os.getenv("DATABASE_REPLICA_URLS", "")
+    return [u.strip() for u in raw.split(",") if u.strip()]
+
+
+if psycopg2 is not None:
+    class PreparedConnection(psycopg2.extensions.connection):
+        """psycopg2 connection that remembers which statements it has PREPAREd."""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+
+
+# ---- Connection pools (one per target: PRIMARY or a replica DSN) ----
+# psycopg2's pools raise PoolError the moment DB_POOL_MAX connections are
+# out. connection() instead waits up to DB_POOL_TIMEOUT seconds (default 5;
+# 0 = fail at once) for a primary connection to come back, so a burst of
+# threads queues instead of failing. Replica borrows never wait: a busy
+# replica pool sends the read to the primary.
+_pools = {}
+_slots = {}   # target -> semaphore with one slot per connection
+_pool_lock = threading.Lock()
+
+def pool_timeout() -> float:
+    return float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+def get_pool(target: str = PRIMARY):
+    pool = _pools.get(target)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(target)
+            if pool is None:
+                if target == PRIMARY:
+                    kwargs = connect_kwargs()
+                else:
+                    # A black-holed replica must fail fast, not after the TCP timeout
+                    kwargs = {"dsn": target,
+                              "connect_timeout": int(os.getenv("DB_REPLICA_CONNECT_TIMEOUT", "2"))}
+                maxconn = int(os.getenv("DB_POOL_MAX", "10"))
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    int(os.getenv("DB_POOL_MIN", "1")),
+                    maxconn,
+                    connection_factory=PreparedConnection,
+                    **kwargs
+                )
+                _slots[target] = threading.BoundedSemaphore(maxconn)
+                _pools[target] = pool
+    return pool
+
+def close_pool():
+    with _pool_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+        _slots.clear()
+
+def pool_stats():
+    """{target: {"in_use", "idle", "max"}} for every pool this process opened."""
+    with _pool_lock:
+        pools = list(_pools.items())
+    replicas = replica_dsns()
+
+    def label(target):
+        # never echo a DSN (it may carry a password)
+        if target == PRIMARY:
+            return PRIMARY
+        return "replica-%d" % replicas.index(target) if target in replicas else "replica"
+
+    return {
+        label(target): {"in_use": len(p._used), "idle": len(p._pool), "max": p.maxconn}
+        for target, p in pools
+    }
+
+@contextmanager
+def connection(target: str = PRIMARY):
+    """Borrow a pooled connection for one transaction (commit on success).
+    Raises PoolError if none is free in time (see pool_timeout())."""
+    p = get_pool(target)
+    slot = _slots[target]
+    wait = pool_timeout() if target == PRIMARY else 0
+    acquired = slot.acquire(timeout=wait) if wait > 0 else slot.acquire(blocking=False)
+    if not acquired:
+        raise psycopg2.pool.PoolError(f"all {p.maxconn} connections in use for {wait:g}s")
+    try:
+        conn = p.getconn()
+    except Exception:
+        slot.release()
+        raise
+    broken = False
+    try:
+        with conn:
+            yield conn
+    except Exception:
+        # PREPARE inside a failed transaction may or may not have survived;
+        # drop them all so the next borrower re-prepares from a clean slate.
+        broken = conn.closed != 0
+        if not broken:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("DEALLOCATE ALL")
+                conn.commit()
+            except Exception:
+                broken = True
+        conn.prepared.clear()
+        raise
+    finally:
+        p.putconn(conn, close=broken or conn.closed != 0)
+        slot.release()
+
+
+# ---- Read-your-writes pinning ----
+# After a user writes (register, deposit, withdraw) their reads go to the
+# primary for DB_PIN_SECONDS so they never see a replica that hasn't caught
+# up yet. The pin must be visible to every gunicorn worker, so by default it
+# lives in a SQLite file on the host (DB_PIN_STORE=path, or "memory" for a
+# single process).
+class MemoryPins:
+    def __init__(self):
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def pin(self, key: str, until: float):
+        now = time.time()
+        with self._lock:
+            self._pins[key] = until
+            if len(self._pins) > 10000:
+                for k in [k for k, u in self._pins.items() if u <= now]:
+                    del self._pins[k]
+
+    def until(self, key: str) -> float:
+        with self._lock:
+            return self._pins.get(key, 0.0)
+
+class SqlitePins:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS pins (key TEXT PRIMARY KEY, until REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def pin(self, key: str, until: float):
+        conn = self._conn()
+        conn.execute("""
+            INSERT INTO pins (key, until) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET until = max(until, excluded.until)
+        """, (key, until))
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            conn.execute("DELETE FROM pins WHERE until <= ?", (time.time(),))
+
+    def until(self, key: str) -> float:
+        row = self._conn().execute("SELECT until FROM pins WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0.0
+
+_pin_store = None
+_pin_store_lock = threading.Lock()
+
+def get_pin_store():
+    global _pin_store
+    if _pin_store is None:
+        with _pin_store_lock:
+            if _pin_store is None:
+                spec = os.getenv("DB_PIN_STORE", "").strip() or \
+                    os.path.join(tempfile.gettempdir(), "stock-trader-pins.db")
+                _pin_store = MemoryPins() if spec == "memory" else SqlitePins(spec)
+    return _pin_store
+
+def pin_primary(user_key: str):
+    if not user_key or not replica_dsns():
+        return
+    try:
+        get_pin_store().pin(user_key, time.time() + float(os.getenv("DB_PIN_SECONDS", "5")))
+    except sqlite3.Error:
+        pass  # store busy; reads may briefly lag, writes are unaffected
+
+def is_pinned(user_key) -> bool:
+    if not user_key:
+        return False
+    try:
+        return get_pin_store().until(user_key) > time.time()
+    except sqlite3.Error:
+        return True  # can't tell; the primary is always safe
+
+
+# ---- Replica health ----
+_replica_state = {}   # dsn -> {"checked": monotonic ts, "ok": bool}
+_replica_lock = threading.Lock()
+_rr = 0
+
+LAG_SQL = """
+    SELECT CASE
+             WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+             ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+           END
+"""
+
+def mark_replica_down(dsn: str):
+    with _replica_lock:
+        _replica_state[dsn] = {"checked": time.monotonic(), "ok": False}
+
+def replica_lag(dsn: str) -> float:
+    """Seconds the replica's replay is behind (0 when caught up)."""
+    with connection(dsn) as conn:
+        with conn.cursor() as cur:
+            cur.execute(LAG_SQL)
+            return float(cur.fetchone()[0] or 0)
+
+def replica_ok(dsn: str) -> bool:
+    """Cached up/lag check; re-probed at most every DB_REPLICA_CHECK_SECONDS."""
+    now = time.monotonic()
+    with _replica_lock:
+        state = _replica_state.get(dsn)
+    if state and now - state["checked"] < float(os.getenv("DB_REPLICA_CHECK_SECONDS", "2")):
+        return state["ok"]
+    try:
+        ok = replica_lag(dsn) <= float(os.getenv("DB_REPLICA_MAX_LAG", "1.0"))
+    except Exception:
+        ok = False
+    with _replica_lock:
+        _replica_state[dsn] = {"checked": now, "ok": ok}
+    return ok
+
+def route(readonly: bool = False, user_key=None) -> str:
+    """PRIMARY for writes and pinned users; otherwise a healthy replica (round robin)."""
+    global _rr
+    replicas = replica_dsns()
+    if not readonly or not replicas or is_pinned(user_key):
+        return PRIMARY
+    with _replica_lock:
+        start = _rr
+        _rr += 1
+    for i in range(len(replicas)):
+        dsn = replicas[(start + i) % len(replicas)]
+        if replica_ok(dsn):
+            return dsn
+    return PRIMARY
+
+
+# ---- Per-statement timing ----
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _record(name: str, elapsed_ms: float):
+    with _stats_lock:
+        s = _stats.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+        s["calls"] += 1
+        s["total_ms"] += elapsed_ms
+        s["max_ms"] = max(s["max_ms"], elapsed_ms)
+
+def statement_stats():
+    """Snapshot of {name: {calls, total_ms, avg_ms, max_ms}}."""
+    with _stats_lock:
+        return {
+            name: dict(s, avg_ms=s["total_ms"] / s["calls"])
+            for name, s in _stats.items()
+        }
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# ---- Execution ----
+def prepare(conn, name: str):
+    """PREPARE `name` on this connection unless it already has been."""
+    if name in conn.prepared:
+        return
+    stmt = STATEMENTS[name]
+    with conn.cursor() as cur:
+        cur.execute("PREPARE %s AS %s" % (stmt.name, stmt.sql))
+    conn.prepared.add(name)
+
+def execute_on(conn, name: str, params=(), fetch: str = "one"):
+    """Run a registered statement on an already-borrowed connection."""
+    prepare(conn, name)
+    placeholders = ", ".join(["%s"] * len(params))
+    sql = "EXECUTE %s(%s)" % (name, placeholders) if params else "EXECUTE %s" % name
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, tuple(params))
+            if fetch == "one":
+                return cur.fetchone()
+            if fetch == "all":
+                return cur.fetchall()
+            return None
+    finally:
+        _record(name, (time.perf_counter() - start) * 1000.0)
+
+def execute(name: str, params=(), fetch: str = "one", readonly: bool = False, user_key=None):
+    """Borrow a connection, run a registered statement, commit, return rows.
+
+    readonly=True lets the statement go to a replica (see route()); if that
+    replica fails mid-call it is marked down and the primary answers instead.
+    """
+    target = route(readonly, user_key)
+    if target != PRIMARY:
+        try:
+            with connection(target) as conn:
+                return execute_on(conn, name, params, fetch)
+        except psycopg2.OperationalError:
+            mark_replica_down(target)
+        except psycopg2.pool.PoolError:
+            pass  # replica pool exhausted; the primary can take this read
+    with connection() as conn:
+        return execute_on(conn, name, params, fetch)
@@ -0,0 +1,246 @@
+from collections import deque
+from datetime import datetime, timezone
+
+# ---- Tax lots ----
+# Open lots for each (user, ticker) sit in a deque in acquisition order, so
+# FIFO sells pop from the left and LIFO sells pop from the right. Specific-lot
+# sells find lots through _by_id and leave an empty lot in the deque; it is
+# dropped when it reaches either end. A sell only touches the lots it closes.
+# Each user's summary is updated on every buy/sell, so reports never replay
+# the trade history. Every change is also passed to `on_change` so the owner
+# can store it (matching.py writes lots and realized gains to Postgres) and
+# load it back with load_lot/load_realized after a restart.
+
+METHODS = ("fifo", "lifo", "specific")
+LONG_TERM_DAYS = 365
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class Lot:
+    __slots__ = ("lot_id", "user", "ticker", "quantity", "price", "acquired_at")
+
+    def __init__(self, lot_id, user, ticker, quantity, price, acquired_at):
+        self.lot_id = lot_id
+        self.user = user
+        self.ticker = ticker
+        self.quantity = quantity
+        self.price = price
+        self.acquired_at = acquired_at
+
+    def to_dict(self):
+        return {
+            "lot_id": self.lot_id, "ticker": self.ticker, "quantity": self.quantity,
+            "price": self.price, "acquired_at": self.acquired_at.isoformat(),
+        }
+
+
+def empty_summary():
+    return {
+        "realized_gain": 0.0,
+        "short_term_gain": 0.0,
+        "long_term_gain": 0.0,
+        "proceeds": 0.0,
+        "cost_basis_sold": 0.0,
+        "by_ticker": {},   # ticker -> realized gain
+        "positions": {},   # ticker -> {"quantity", "cost_basis"} of open lots
+    }
+
+
+def merge_summaries(summaries):
+    """Combine per-shard summaries for one user into a single report."""
+    out = empty_summary()
+    for s in summaries:
+        for k in ("realized_gain", "short_term_gain", "long_term_gain", "proceeds", "cost_basis_sold"):
+            out[k] += s[k]
+        for t, g in s["by_ticker"].items():
+            out["by_ticker"][t] = out["by_ticker"].get(t, 0.0) + g
+        for t, p in s["positions"].items():
+            pos = out["positions"].setdefault(t, {"quantity": 0, "cost_basis": 0.0})
+            pos["quantity"] += p["quantity"]
+            pos["cost_basis"] += p["cost_basis"]
+    return out
+
+
+class LotLedger:
+    def __init__(self, id_prefix: str = "", on_change=None):
+        self.id_prefix = id_prefix   # lot ids are <prefix>L<n>, realized records <prefix>R<n>
+        self.on_change = on_change   # on_change(kind, user, row); kind "lot" or "realized"
+        self._open = {}       # (user, ticker) -> deque[Lot]
+        self._held = {}       # user -> {ticker: None} for each of their _open keys, in order
+        self._by_id = {}      # lot_id -> Lot (open lots only)
+        self._summary = {}    # user -> summary dict
+        self._realized = {}   # user -> [realized-gain records]
+        self._next_id = 0
+        self._next_record = 0
+
+    def _user_summary(self, user):
+        s = self._summary.get(user)
+        if s is None:
+            s = self._summary[user] = empty_summary()
+        return s
+
+    def buy(self, user, ticker: str, quantity: int, price: float, acquired_at=None) -> Lot:
+        if quantity <= 0 or price <= 0:
+            raise ValueError("quantity and price must be > 0")
+        self._next_id += 1
+        lot = self._add(Lot(f"{self.id_prefix}L{self._next_id}", user, ticker, int(quantity), float(price),
+                            acquired_at or _now()))
+        if self.on_change:
+            self.on_change("lot", user, lot.to_dict())
+        return lot
+
+    def _add(self, lot: Lot) -> Lot:
+        q = self._open.get((lot.user, lot.ticker))
+        if q is None:
+            q = self._open[(lot.user, lot.ticker)] = deque()
+            self._held.setdefault(lot.user, {})[lot.ticker] = None
+        q.append(lot)
+        self._by_id[lot.lot_id] = lot
+        pos = self._user_summary(lot.user)["positions"].setdefault(lot.ticker, {"quantity": 0, "cost_basis": 0.0})
+        pos["quantity"] += lot.quantity
+        pos["cost_basis"] += lot.quantity * lot.price
+        return lot
+
+    # -- restore (rows as stored from on_change; lots in acquisition order) --
+    def load_lot(self, user, row: dict):
+        """Re-open a stored lot that still has shares."""
+        acquired_at = row["acquired_at"]
+        if isinstance(acquired_at, str):
+            acquired_at = datetime.fromisoformat(acquired_at)
+        acquired_at = acquired_at.astimezone(timezone.utc)
+        self._add(Lot(row["lot_id"], user, row["ticker"], int(row["quantity"]), float(row["price"]), acquired_at))
+
+    def load_realized(self, user, record: dict):
+        """Re-count a stored realized-gain record in the user's summary."""
+        self._count_realized(self._user_summary(user), record)
+        self._realized.setdefault(user, []).append(record)
+
+    @staticmethod
+    def _count_realized(s, record):
+        s["realized_gain"] += record["gain"]
+        s[f"{record['term']}_term_gain"] += record["gain"]
+        s["proceeds"] += record["proceeds"]
+        s["cost_basis_sold"] += record["cost_basis"]
+        s["by_ticker"][record["ticker"]] = s["by_ticker"].get(record["ticker"], 0.0) + record["gain"]
+
+    def open_quantity(self, user, ticker: str) -> int:
+        pos = self._summary.get(user, {}).get("positions", {}).get(ticker)
+        return pos["quantity"] if pos else 0
+
+    def specific_quantity(self, user, ticker: str, lot_ids) -> int:
+        """Shares available in the named lots (0 for lots that aren't this user's)."""
+        total = 0
+        for lot_id in set(lot_ids or ()):
+            lot = self._by_id.get(lot_id)
+            if lot is not None and lot.user == user and lot.ticker == ticker:
+                total += lot.quantity
+        return total
+
+    def open_lots(self, user, ticker: str = None):
+        keys = [(user, ticker)] if ticker else [(user, t) for t in self._held.get(user, ())]
+        return [lot.to_dict() for k in keys for lot in self._open.get(k, ()) if lot.quantity > 0]
+
+    def sell(self, user, ticker: str, quantity: int, price: float, method: str = "fifo",
+             lot_ids=None, sold_at=None):
+        """Close `quantity` shares at `price`; returns the realized-gain records.
+        Nothing changes if the chosen lots can't cover the whole quantity."""
+        quantity, price = int(quantity), float(price)
+        method = (method or "fifo").lower()
+        if method not in METHODS:
+            raise ValueError(f"lot method must be one of {', '.join(METHODS)}")
+        if quantity <= 0:
+            raise ValueError("quantity must be > 0")
+        if method == "specific":
+            if self.specific_quantity(user, ticker, lot_ids) < quantity:
+                raise ValueError("Selected lots do not cover the quantity")
+        elif self.open_quantity(user, ticker) < quantity:
+            raise ValueError("Insufficient shares")
+
+        sold_at = sold_at or _now()
+        q = self._open[(user, ticker)]
+        records = []
+        remaining = quantity
+
+        if method == "specific":
+            for lot_id in dict.fromkeys(lot_ids):
+                lot = self._by_id.get(lot_id)
+                if remaining == 0:
+                    break
+                if lot is None or lot.user != user or lot.ticker != ticker:
+                    continue
+                remaining -= self._close(lot, min(remaining, lot.quantity), price, sold_at, records)
+            # Exhausted lots left at either end can go now; middle ones go later
+            while q and q[0].quantity == 0:
+                q.popleft()
+            while q and q[-1].quantity == 0:
+                q.pop()
+        else:
+            pop, peek = (q.popleft, 0) if method == "fifo" else (q.pop, -1)
+            while remaining > 0:
+                lot = q[peek]
+                if lot.quantity > 0:
+                    remaining -= self._close(lot, min(remaining, lot.quantity), price, sold_at, records)
+                if lot.quantity == 0:
+                    pop()
+
+        if not q:
+            del self._open[(user, ticker)]
+            held = self._held[user]
+            del held[ticker]
+            if not held:
+                del self._held[user]
+        self._realized.setdefault(user, []).extend(records)
+        return records
+
+    def _close(self, lot: Lot, n: int, price: float, sold_at, records) -> int:
+        cost = n * lot.price
+        proceeds = n * price
+        gain = proceeds - cost
+        days = (sold_at - lot.acquired_at).days
+        term = "long" if days > LONG_TERM_DAYS else "short"
+
+        lot.quantity -= n
+        if lot.quantity == 0:
+            self._by_id.pop(lot.lot_id, None)
+
+        self._next_record += 1
+        record = {
+            "record_id": f"{self.id_prefix}R{self._next_record}", "lot_id": lot.lot_id, "ticker": lot.ticker, "quantity": n,
+            "cost_basis": cost, "proceeds": proceeds, "gain": gain, "term": term,
+            "acquired_at": lot.acquired_at.isoformat(), "sold_at": sold_at.isoformat(),
+        }
+        s = self._user_summary(lot.user)
+        self._count_realized(s, record)
+        pos = s["positions"][lot.ticker]
+        pos["quantity"] -= n
+        pos["cost_basis"] -= cost
+        if pos["quantity"] == 0:
+            del s["positions"][lot.ticker]
+
+        records.append(record)
+        if self.on_change:
+            self.on_change("lot", lot.user, lot.to_dict())
+            self.on_change("realized", lot.user, record)
+        return n
+
+    def drop_user(self, user):
+        """Forget everything held for `user` (the account is being deleted)."""
+        for ticker in self._held.pop(user, ()):
+            for lot in self._open.pop((user, ticker)):
+                self._by_id.pop(lot.lot_id, None)
+        self._summary.pop(user, None)
+        self._realized.pop(user, None)
+
+    def summary(self, user) -> dict:
+        s = self._summary.get(user)
+        if s is None:
+            return empty_summary()
+        return {**s, "by_ticker": dict(s["by_ticker"]),
+                "positions": {t: dict(p) for t, p in s["positions"].items()}}
+
+    def realized(self, user, limit: int = 100):
+        """Most recent realized-gain records, newest last."""
+        return list(self._realized.get(user, [])[-limit:])
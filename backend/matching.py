@@ -0,0 +1,522 @@
+import os, sys, json, math, stat, time, uuid, heapq, zlib, queue, threading, argparse
+import multiprocessing
+from datetime import datetime, timezone
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import db
+import lots
+
+# ---- Sharding ----
+# Tickers are split across engine processes by a stable hash (crc32, not
+# Python's per-process randomized hash()), so every HTTP worker routes a
+# ticker to the same engine and that engine alone orders its fills.
+def shard_for(ticker: str, shards: int) -> int:
+    return zlib.crc32(ticker.strip().upper().encode()) % shards
+
+def socket_path(socket_dir: str, index: int) -> str:
+    return os.path.join(socket_dir, f"shard-{index}.sock")
+
+class EngineError(Exception):
+    pass
+
+
+# ---- Transport ----
+# Shards and HTTP workers talk over AF_UNIX sockets with the multiprocessing
+# challenge handshake (ENGINE_AUTHKEY, no default) and then exchange JSON,
+# never pickles, so a peer can at worst send a bad order. The socket
+# directory must belong to this user and be closed to everyone else, or a
+# local user could stand in for a shard.
+MAX_REQUEST_BYTES = 64 * 1024
+
+def authkey() -> bytes:
+    key = os.getenv("ENGINE_AUTHKEY", "")
+    if not key:
+        raise EngineError("ENGINE_AUTHKEY is not set (shared secret for the engine sockets)")
+    return key.encode()
+
+def secure_socket_dir(socket_dir: str, create: bool = False):
+    """Make sure only this user can reach the shard sockets."""
+    if create:
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    try:
+        st = os.lstat(socket_dir)
+    except FileNotFoundError:
+        raise EngineError(f"socket dir {socket_dir} does not exist (engines not started?)")
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise EngineError(f"socket dir {socket_dir} must be a directory owned by uid {os.getuid()}")
+    if st.st_mode & 0o077:
+        if not create:
+            raise EngineError(f"socket dir {socket_dir} must not be accessible to group/others")
+        os.chmod(socket_dir, 0o700)
+
+def send_msg(conn, msg: dict):
+    conn.send_bytes(json.dumps(msg).encode())
+
+def recv_msg(conn, maxlength: int = None) -> dict:
+    return json.loads(conn.recv_bytes(maxlength))
+
+
+# ---- Order book (price-time priority) ----
+class OrderBook:
+    """Limit order book for one ticker. Orders without a limit_price are
+    market orders: they take what liquidity exists and the rest is cancelled."""
+
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.bids = []   # heap of (-price, seq, order)
+        self.asks = []   # heap of (price, seq, order)
+        self.seq = 0
+        self.fill_seq = 0
+
+    def submit(self, order: dict) -> dict:
+        self.seq += 1
+        side = order["side"]
+        qty = int(order["quantity"])
+        limit = order.get("limit_price")
+        limit = float(limit) if limit is not None else None
+        taker = {"order_id": order["order_id"], "user": order.get("user"),
+                 "side": side, "remaining": qty, "price": limit,
+                 "lot_method": order.get("lot_method"), "lot_ids": order.get("lot_ids")}
+
+        book = self.asks if side == "buy" else self.bids
+        fills = []
+        while taker["remaining"] > 0 and book:
+            key, _, maker = book[0]
+            price = key if side == "buy" else -key
+            if limit is not None and (price > limit if side == "buy" else price < limit):
+                break
+            n = min(taker["remaining"], maker["remaining"])
+            self.fill_seq += 1
+            fills.append({
+                "seq": self.fill_seq, "ticker": self.ticker, "price": price, "quantity": n,
+                "taker_order_id": taker["order_id"], "maker_order_id": maker["order_id"],
+                "buyer": taker["user"] if side == "buy" else maker["user"],
+                "seller": maker["user"] if side == "buy" else taker["user"],
+                "seller_order": maker if side == "buy" else taker,
+            })
+            taker["remaining"] -= n
+            maker["remaining"] -= n
+            if maker["remaining"] == 0:
+                heapq.heappop(book)
+
+        if taker["remaining"] > 0 and limit is not None:
+            if side == "buy":
+                heapq.heappush(self.bids, (-limit, self.seq, taker))
+            else:
+                heapq.heappush(self.asks, (limit, self.seq, taker))
+            status = "partially_filled" if fills else "open"
+        elif taker["remaining"] > 0:
+            status = "partially_filled" if fills else "cancelled"
+        else:
+            status = "filled"
+
+        return {
+            "order_id": taker["order_id"], "status": status,
+            "filled": qty - taker["remaining"], "remaining": taker["remaining"],
+            "fills": fills,
+        }
+
+    def cancel_users(self, users) -> int:
+        """Drop every resting order placed by one of `users`; returns how many."""
+        before = len(self.bids) + len(self.asks)
+        self.bids = [e for e in self.bids if e[2]["user"] not in users]
+        self.asks = [e for e in self.asks if e[2]["user"] not in users]
+        heapq.heapify(self.bids)
+        heapq.heapify(self.asks)
+        return before - len(self.bids) - len(self.asks)
+
+    def top(self) -> dict:
+        return {
+            "ticker": self.ticker,
+            "bid": -self.bids[0][0] if self.bids else None,
+            "ask": self.asks[0][0] if self.asks else None,
+        }
+
+
+# ---- Ledger persistence ----
+# Lots and realized gains are written behind the matcher by one thread per
+# shard, in the order they happened, and read back when the shard starts.
+# Lost connections are retried with backoff, and every write is idempotent
+# (lot upserts, realized rows keyed by record_id), so a retried batch never
+# double-counts. A row the database refuses (e.g. its user was deleted) is
+# found by splitting the batch, logged and skipped. Past PERSIST_BACKLOG_MAX
+# unsaved changes the shard turns orders away; changes still queued when a
+# shard is killed are lost.
+LOTS_SQL = """
+    INSERT INTO lots (lot_id, username, ticker, quantity, price, acquired_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (lot_id) DO UPDATE SET quantity = EXCLUDED.quantity
+"""
+REALIZED_SQL = """
+    INSERT INTO realized_gains (record_id, lot_id, username, ticker, quantity, cost_basis, proceeds,
+                                gain, term, acquired_at, sold_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (record_id) DO NOTHING
+"""
+PERSIST_BATCH = 500
+PERSIST_BACKLOG_MAX = 50000
+PERSIST_RETRY_MAX_SECONDS = 30
+
+def save_changes(changes):
+    """Write (kind, user, row) changes from LotLedger.on_change in one transaction."""
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            for kind, user, row in changes:
+                if kind == "lot":
+                    cur.execute(LOTS_SQL, (row["lot_id"], user, row["ticker"], row["quantity"],
+                                           row["price"], row["acquired_at"]))
+                else:
+                    cur.execute(REALIZED_SQL, (row["record_id"], row["lot_id"], user, row["ticker"], row["quantity"],
+                                               row["cost_basis"], row["proceeds"], row["gain"],
+                                               row["term"], row["acquired_at"], row["sold_at"]))
+
+def load_ledger(ledger, index: int, shards: int):
+    """Re-open this shard's lots and re-count its realized gains."""
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT lot_id, username, ticker, quantity, price, acquired_at
+                FROM lots WHERE quantity > 0 ORDER BY id
+            """)
+            for lot_id, user, ticker, quantity, price, acquired_at in cur.fetchall():
+                if shard_for(ticker, shards) == index:
+                    ledger.load_lot(user, {"lot_id": lot_id, "ticker": ticker, "quantity": quantity,
+                                           "price": price, "acquired_at": acquired_at})
+            cur.execute("""
+                SELECT record_id, lot_id, username, ticker, quantity, cost_basis, proceeds, gain, term,
+                       acquired_at, sold_at
+                FROM realized_gains ORDER BY id
+            """)
+            for record_id, lot_id, user, ticker, quantity, cost, proceeds, gain, term, acquired_at, sold_at \
+                    in cur.fetchall():
+                if shard_for(ticker, shards) == index:
+                    ledger.load_realized(user, {
+                        "record_id": record_id, "lot_id": lot_id, "ticker": ticker, "quantity": quantity,
+                        "cost_basis": float(cost), "proceeds": float(proceeds), "gain": float(gain),
+                        # UTC, like live records, whatever the session time zone
+                        "term": term, "acquired_at": acquired_at.astimezone(timezone.utc).isoformat(),
+                        "sold_at": sold_at.astimezone(timezone.utc).isoformat(),
+                    })
+
+def _transient(e: Exception) -> bool:
+    """Errors worth retrying as-is: the database or the pool, not the data."""
+    pg = db.psycopg2
+    return pg is None or isinstance(e, (pg.OperationalError, pg.InterfaceError, pg.pool.PoolError))
+
+def save_batch(batch, index: int) -> int:
+    """Save `batch` in order, skipping rows the database refuses; returns
+    how many were skipped. Transient errors propagate for a retry."""
+    try:
+        save_changes(batch)
+        return 0
+    except Exception as e:
+        if _transient(e):
+            raise
+        if len(batch) == 1:
+            kind, user, row = batch[0]
+            print(f"shard {index}: skipping {kind} {row.get('record_id') or row['lot_id']} "
+                  f"for {user!r}: {e}", file=sys.stderr)
+            return 1
+        mid = len(batch) // 2
+        return save_batch(batch[:mid], index) + save_batch(batch[mid:], index)
+
+def persister(changes: queue.Queue, index: int):
+    batch = []
+    delay = 1
+    while True:
+        if not batch:
+            batch.append(changes.get())
+        while len(batch) < PERSIST_BATCH:
+            try:
+                batch.append(changes.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            save_batch(batch, index)
+            batch = []
+            delay = 1
+        except Exception as e:
+            print(f"shard {index}: saving lots failed, retrying in {delay}s: {e}", file=sys.stderr)
+            time.sleep(delay)
+            delay = min(delay * 2, PERSIST_RETRY_MAX_SECONDS)
+
+
+# ---- Engine process ----
+def _whole_shares(value):
+    """Share count as an int; None unless `value` is a positive whole number."""
+    try:
+        n = float(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(value, bool) or not math.isfinite(n) or n <= 0 or n != int(n):
+        return None
+    return int(n)
+
+def validate(order: dict):
+    ticker = (order.get("ticker") or "").strip().upper()
+    side = (order.get("side") or "").strip().lower()
+    quantity = _whole_shares(order.get("quantity"))
+    limit = order.get("limit_price")
+    if not ticker or side not in ("buy", "sell") or quantity is None:
+        raise ValueError("ticker, side (buy/sell) and a positive whole quantity required")
+    if limit is not None:
+        try:
+            limit = float(limit)
+        except (TypeError, ValueError):
+            raise ValueError("limit_price must be a number")
+        # NaN/inf would sit at the top of the book and fill at that "price"
+        if not math.isfinite(limit) or limit <= 0:
+            raise ValueError("limit_price must be a finite number > 0")
+    lot_method = (order.get("lot_method") or "fifo").strip().lower()
+    if lot_method not in lots.METHODS:
+        raise ValueError(f"lot_method must be one of {', '.join(lots.METHODS)}")
+    lot_ids = [str(i) for i in (order.get("lot_ids") or [])]
+    if lot_method == "specific" and not lot_ids:
+        raise ValueError("lot_ids required for specific-lot sells")
+    return dict(order, ticker=ticker, side=side, quantity=quantity, limit_price=limit,
+                lot_method=lot_method, lot_ids=lot_ids)
+
+def run_shard(index: int, shards: int, socket_dir: str, persist: bool = True):
+    """Serve one shard: reader threads queue requests, one thread matches them.
+
+    The shard also owns the tax lots for its tickers: fills are applied to
+    its LotLedger in the same order they happen. Orders with no user are
+    house liquidity and carry no lots. With `persist`, the ledger is loaded
+    from Postgres before the socket opens and every change is saved back.
+    """
+    # Lot ids stay unique across restarts and re-sharding
+    ledger = lots.LotLedger(id_prefix=f"{index}.{uuid.uuid4().hex[:6]}-")
+    changes = queue.Queue()
+    if persist:
+        load_ledger(ledger, index, shards)
+        ledger.on_change = lambda kind, user, row: changes.put((kind, user, row))
+        threading.Thread(target=persister, args=(changes, index), daemon=True).start()
+
+    secure_socket_dir(socket_dir)
+    path = socket_path(socket_dir, index)
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = Listener(path, family="AF_UNIX", authkey=authkey())
+    inbox = queue.Queue()
+    books = {}
+    counter = [0]
+    reserved = {}   # (user, ticker) -> shares held by resting sell orders
+
+    def settle(order, ack):
+        realized = []
+        for fill in ack["fills"]:
+            seller_order = fill.pop("seller_order")
+            if fill["buyer"] is not None:
+                ledger.buy(fill["buyer"], fill["ticker"], fill["quantity"], fill["price"])
+            if fill["seller"] is None:
+                continue
+            key = (fill["seller"], fill["ticker"])
+            if seller_order["order_id"] != order["order_id"]:
+                reserved[key] -= fill["quantity"]
+            try:
+                records = ledger.sell(fill["seller"], fill["ticker"], fill["quantity"], fill["price"],
+                                      method=seller_order["lot_method"], lot_ids=seller_order["lot_ids"])
+            except ValueError:
+                # Named lots were closed by another fill meanwhile; the
+                # reservation guarantees FIFO can still cover it
+                records = ledger.sell(fill["seller"], fill["ticker"], fill["quantity"], fill["price"])
+            if fill["seller"] == order.get("user"):
+                realized.extend(records)
+        if order["side"] == "sell" and order.get("user") is not None \
+                and ack["remaining"] > 0 and order["limit_price"] is not None:
+            key = (order["user"], order["ticker"])
+            reserved[key] = reserved.get(key, 0) + ack["remaining"]
+        ack["realized"] = realized
+        for fill in ack["fills"]:
+            # Counterparties stay inside the engine
+            del fill["buyer"], fill["seller"]
+        return ack
+
+    def check_holdings(order):
+        user, ticker = order.get("user"), order["ticker"]
+        if order["side"] != "sell" or user is None:
+            return
+        available = ledger.open_quantity(user, ticker) - reserved.get((user, ticker), 0)
+        if available < order["quantity"]:
+            raise ValueError("Insufficient shares")
+        if order["lot_method"] == "specific" and \
+                ledger.specific_quantity(user, ticker, order["lot_ids"]) < order["quantity"]:
+            raise ValueError("Selected lots do not cover the quantity")
+
+    def handle(msg):
+        op = msg.get("op")
+        if op == "submit":
+            order = validate(msg.get("order") or {})
+            if shard_for(order["ticker"], shards) != index:
+                raise ValueError(f"{order['ticker']} does not belong to shard {index}")
+            check_holdings(order)
+            if changes.qsize() >= PERSIST_BACKLOG_MAX:
+                raise EngineError(f"shard {index} is behind on saving lots; try again shortly")
+            counter[0] += 1
+            order["order_id"] = f"{index}-{counter[0]}"
+            book = books.setdefault(order["ticker"], OrderBook(order["ticker"]))
+            return settle(order, book.submit(order))
+        if op == "summary":
+            return ledger.summary(msg.get("user"))
+        if op == "lots":
+            return ledger.open_lots(msg.get("user"))
+        if op == "realized":
+            return ledger.realized(msg.get("user"), int(msg.get("limit", 100)))
+        if op == "top":
+            ticker = (msg.get("ticker") or "").strip().upper()
+            return books.get(ticker, OrderBook(ticker)).top()
+        if op == "purge":
+            # Users about to be deleted: nothing of theirs may fill or be saved again
+            users = set(msg.get("users") or ())
+            cancelled = sum(book.cancel_users(users) for book in books.values())
+            for key in [k for k in reserved if k[0] in users]:
+                del reserved[key]
+            for user in users:
+                ledger.drop_user(user)
+            return {"cancelled": cancelled}
+        if op == "ping":
+            return {"shard": index}
+        raise ValueError(f"unknown op {op!r}")
+
+    def matcher():
+        while True:
+            conn, msg = inbox.get()
+            try:
+                reply = {"ok": True, "result": handle(msg)}
+            except EngineError as e:
+                reply = {"ok": False, "error": str(e), "busy": True}
+            except Exception as e:
+                # Reject this message; the matcher thread must keep running
+                reply = {"ok": False, "error": str(e)}
+            try:
+                send_msg(conn, reply)
+            except (OSError, EOFError):
+                pass
+
+    def reader(conn):
+        try:
+            while True:
+                inbox.put((conn, recv_msg(conn, MAX_REQUEST_BYTES)))
+        except (OSError, EOFError, ValueError):
+            # closed, oversized or not JSON: drop the connection
+            conn.close()
+
+    threading.Thread(target=matcher, daemon=True).start()
+    while True:
+        try:
+            conn = listener.accept()
+        except (AuthenticationError, OSError, EOFError):
+            continue   # wrong key or peer hung up during the handshake
+        threading.Thread(target=reader, args=(conn,), daemon=True).start()
+
+def start_engines(shards: int, socket_dir: str, persist: bool = True):
+    """Spawn one engine process per shard; returns the Process objects."""
+    authkey()   # fail here, not in every shard
+    secure_socket_dir(socket_dir, create=True)
+    # spawn, not fork: each shard opens its own DB pool instead of sharing the parent's sockets
+    ctx = multiprocessing.get_context("spawn")
+    procs = []
+    for i in range(shards):
+        p = ctx.Process(target=run_shard, args=(i, shards, socket_dir, persist), daemon=True)
+        p.start()
+        procs.append(p)
+    return procs
+
+
+# ---- Client used by HTTP workers ----
+class EngineClient:
+    """One socket per shard per worker process; each call waits for its ack."""
+
+    def __init__(self, socket_dir: str, shards: int):
+        self.socket_dir = socket_dir
+        self.shards = shards
+        self._conns = {}
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def _call(self, index: int, msg: dict) -> dict:
+        with self._locks[index]:
+            conn = self._conns.get(index)
+            try:
+                if conn is None:
+                    secure_socket_dir(self.socket_dir)
+                    conn = Client(socket_path(self.socket_dir, index), family="AF_UNIX", authkey=authkey())
+                    self._conns[index] = conn
+                send_msg(conn, msg)
+                reply = recv_msg(conn)
+            except (OSError, EOFError, ValueError, AuthenticationError) as e:
+                self._conns.pop(index, None)
+                raise EngineError(f"shard {index} unavailable: {e}")
+        if not reply.get("ok"):
+            if reply.get("busy"):
+                raise EngineError(reply["error"])
+            raise ValueError(reply.get("error") or "order rejected")
+        return reply["result"]
+
+    def ping(self, index: int) -> dict:
+        return self._call(index, {"op": "ping"})
+
+    def wait_ready(self, timeout: float = 5.0):
+        """Block until every shard answers a ping (engines just started)."""
+        deadline = time.monotonic() + timeout
+        for i in range(self.shards):
+            while True:
+                try:
+                    self.ping(i)
+                    break
+                except EngineError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+
+    def submit(self, order: dict) -> dict:
+        ticker = (order.get("ticker") or "").strip().upper()
+        if not ticker:
+            raise ValueError("ticker required")
+        return self._call(shard_for(ticker, self.shards), {"op": "submit", "order": order})
+
+    def top(self, ticker: str) -> dict:
+        return self._call(shard_for(ticker, self.shards), {"op": "top", "ticker": ticker})
+
+    def purge_users(self, users) -> int:
+        """Cancel the users' resting orders and forget their lots on every
+        shard (before deleting the users); returns the orders cancelled."""
+        return sum(r["cancelled"] for r in self._all({"op": "purge", "users": list(users)}))
+
+    def _all(self, msg: dict):
+        return [self._call(i, msg) for i in range(self.shards)]
+
+    def summary(self, user: str) -> dict:
+        """Realized gains and open positions, merged from every shard."""
+        return lots.merge_summaries(self._all({"op": "summary", "user": user}))
+
+    def open_lots(self, user: str):
+        return [lot for shard in self._all({"op": "lots", "user": user}) for lot in shard]
+
+    def realized(self, user: str, limit: int = 100):
+        records = [r for shard in self._all({"op": "realized", "user": user, "limit": limit}) for r in shard]
+        return sorted(records, key=lambda r: datetime.fromisoformat(r["sold_at"]))[-limit:]
+
+
+def engine_config():
+    """ENGINE_SOCKET_DIR / ENGINE_SHARDS; both sides must agree on the shard count.
+    The directory is created 0700 by the engines; pick a private path in production."""
+    return (
+        os.getenv("ENGINE_SOCKET_DIR", "/tmp/stock-engine"),
+        int(os.getenv("ENGINE_SHARDS") or os.cpu_count() or 1),
+    )
+
+
+if __name__ == "__main__":
+    # Run beside gunicorn, as the same user and with the same ENGINE_AUTHKEY:
+    #   ENGINE_AUTHKEY=... python matching.py --shards 4
+    socket_dir, shards = engine_config()
+    parser = argparse.ArgumentParser(description="Sharded order-matching engines")
+    parser.add_argument("--shards", type=int, default=shards)
+    parser.add_argument("--socket-dir", default=socket_dir)
+    parser.add_argument("--no-persist", action="store_true",
+                        help="keep lots in memory only (they are lost when a shard stops)")
+    args = parser.parse_args()
+    procs = start_engines(args.shards, args.socket_dir, persist=not args.no_persist)
+    print(f"{args.shards} engine shard(s) listening in {args.socket_dir}", file=sys.stderr)
+    for p in procs:
+        p.join()
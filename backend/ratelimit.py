@@ -0,0 +1,297 @@
+import os, time, math, sqlite3, tempfile, threading
+from flask import request, jsonify, g
+
+# ---- Route classes ----
+# Limits are "N/S" (N requests per S seconds, bursts up to N) and can be
+# overridden with RATE_LIMIT_<CLASS>, e.g. RATE_LIMIT_CASH="5/60". "off" disables.
+ROUTE_CLASSES = [
+    ("/auth/", "auth"),
+    ("/cash/", "cash"),
+    ("/market/", "market"),
+    ("/admin/", "admin"),
+    ("/dbcheck/", "admin"),
+    ("/trade/", "trade"),
+    ("/portfolio/", "portfolio"),
+]
+
+DEFAULT_LIMITS = {
+    "auth": "10/60",
+    "cash": "30/60",
+    "market": "120/60",
+    "admin": "30/60",
+    "trade": "60/60",
+    "portfolio": "30/60",   # each call asks every engine shard
+}
+
+def route_class(path: str):
+    for prefix, name in ROUTE_CLASSES:
+        if path.startswith(prefix):
+            return name
+    return None
+
+def parse_limit(spec: str):
+    """"N/S" -> (rate per second, burst); None when disabled."""
+    spec = (spec or "").strip().lower()
+    if not spec or spec in ("off", "0", "none"):
+        return None
+    n, _, s = spec.partition("/")
+    n, s = float(n), float(s or 1)
+    if n <= 0 or s <= 0:
+        return None
+    return n / s, n
+
+def limit_for(cls: str):
+    return parse_limit(os.getenv("RATE_LIMIT_" + cls.upper(), DEFAULT_LIMITS.get(cls, "")))
+
+
+# ---- Token bucket stores ----
+# Each bucket keeps its own rate and burst, so pruning never applies one
+# route class's limits to another's buckets. Stores also count requests in
+# flight, which is what overload shedding compares against SHED_MAX_INFLIGHT.
+INFLIGHT_STALE_SECONDS = 60   # a worker killed mid-request stops counting after this
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+class MemoryStore:
+    """Buckets and in-flight count for this process only (one worker)."""
+    def __init__(self):
+        self._buckets = {}   # key -> (tokens, updated, rate, burst)
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, now: float = None):
+        """Spend one token; returns (allowed, retry_after_seconds)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated, _, _ = self._buckets.get(key, (burst, now, rate, burst))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now, rate, burst)
+                allowed, retry = True, 0.0
+            else:
+                self._buckets[key] = (tokens, now, rate, burst)
+                allowed, retry = False, (1 - tokens) / rate
+            if len(self._buckets) > 50000:
+                self._sweep(now)
+        return allowed, retry
+
+    def _sweep(self, now):
+        # A bucket that has refilled completely is the same as no bucket
+        for k in [k for k, (t, u, r, b) in self._buckets.items() if _refill(t, u, now, r, b) >= b]:
+            del self._buckets[k]
+
+    def acquire(self, limit: int):
+        """Count one request in flight; None when `limit` is already reached."""
+        with self._lock:
+            if self._inflight >= limit:
+                return None
+            self._inflight += 1
+            return True
+
+    def release(self, token):
+        with self._lock:
+            self._inflight -= 1
+
+class SqliteStore:
+    """Buckets and in-flight requests in a local SQLite file shared by every
+    worker on the host. Locked/unavailable store: fail open."""
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._ops = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS token_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                rate REAL NOT NULL,
+                burst REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS inflight (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started REAL NOT NULL
+            )
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _rollback(self, conn):
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+
+    def take(self, key: str, rate: float, burst: float, now: float = None):
+        now = time.time() if now is None else now
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated FROM token_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = _refill(row[0], row[1], now, rate, burst) if row else burst
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("""
+                INSERT INTO token_buckets (key, tokens, updated, rate, burst) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated,
+                                                rate = excluded.rate, burst = excluded.burst
+            """, (key, tokens, now, rate, burst))
+            self._ops += 1
+            if self._ops % self.PRUNE_EVERY == 0:
+                self._prune(conn, now)
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError:
+            self._rollback(conn)
+            return True, 0.0
+        return allowed, (0.0 if allowed else (1 - tokens) / rate)
+
+    def _prune(self, conn, now):
+        conn.execute("DELETE FROM token_buckets WHERE tokens + (? - updated) * rate >= burst", (now,))
+
+    def acquire(self, limit: int):
+        now = time.time()
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM inflight WHERE started < ?", (now - INFLIGHT_STALE_SECONDS,))
+            count = conn.execute("SELECT count(*) FROM inflight").fetchone()[0]
+            if count >= limit:
+                conn.execute("COMMIT")
+                return None
+            token = conn.execute("INSERT INTO inflight (started) VALUES (?)", (now,)).lastrowid
+            conn.execute("COMMIT")
+            return token
+        except sqlite3.OperationalError:
+            self._rollback(conn)
+            return 0   # not recorded; release() is then a no-op
+
+    def release(self, token):
+        if not token:
+            return
+        try:
+            self._conn().execute("DELETE FROM inflight WHERE id = ?", (token,))
+        except sqlite3.OperationalError:
+            pass   # expires after INFLIGHT_STALE_SECONDS
+
+def make_store():
+    """RATE_LIMIT_STORE: path of the shared SQLite file (default: one in the
+    temp dir, shared by every worker on the host) or "memory"."""
+    spec = os.getenv("RATE_LIMIT_STORE", "").strip()
+    if spec == "memory":
+        return MemoryStore()
+    return SqliteStore(spec or os.path.join(tempfile.gettempdir(), "stock-trader-ratelimit.db"))
+
+
+# ---- Client identity ----
+def client_ip(req, proxy_hops: int):
+    """The address `proxy_hops` trusted proxies saw the request come from.
+
+    Each proxy appends the address it received from to X-Forwarded-For, so
+    the entry `proxy_hops` from the right is the client; anything left of it
+    is client-supplied and can't be trusted."""
+    if proxy_hops > 0:
+        forwarded = [a.strip() for a in req.headers.get("X-Forwarded-For", "").split(",") if a.strip()]
+        if forwarded:
+            return forwarded[-min(proxy_hops, len(forwarded))]
+    return req.remote_addr
+
+
+# ---- Load shedding ----
+def queue_delay_ms(header: str, now: float = None):
+    """Time since the proxy saw the request, from X-Request-Start ("t=<ts>").
+    Accepts seconds, milliseconds or microseconds; None if absent/unparseable."""
+    if not header:
+        return None
+    raw = header.strip()
+    if raw.startswith("t="):
+        raw = raw[2:]
+    try:
+        ts = float(raw)
+    except ValueError:
+        return None
+    if ts > 1e14:
+        ts /= 1e6
+    elif ts > 1e11:
+        ts /= 1e3
+    now = time.time() if now is None else now
+    return max(0.0, (now - ts) * 1000.0)
+
+def _retry_response(status: int, detail: str, retry_after: float):
+    resp = jsonify({"detail": detail})
+    resp.status_code = status
+    resp.headers["Retry-After"] = str(max(1, int(math.ceil(retry_after))))
+    return resp
+
+
+def init_app(app, user_key=None, store=None):
+    """Install token buckets and overload shedding on `app`.
+
+    Every caller is limited per client IP, resolved through
+    RATE_LIMIT_PROXY_HOPS trusted proxies (default 1: the gateway). Signed-in
+    callers (user_key() returns their username without touching the DB) are
+    also limited per user, and their IP bucket is RATE_LIMIT_IP_FACTOR
+    (default 4) times the class limit so users behind one NAT don't starve
+    each other, while extra accounts from one address still share a cap.
+    SHED_MAX_INFLIGHT caps requests in flight across all workers sharing
+    the store (503 above it); SHED_QUEUE_MS sheds requests that already
+    waited that long upstream.
+    """
+    store = store or make_store()
+    max_inflight = int(os.getenv("SHED_MAX_INFLIGHT", "100"))
+    max_queue_ms = float(os.getenv("SHED_QUEUE_MS", "0"))
+    proxy_hops = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "1"))
+    ip_factor = float(os.getenv("RATE_LIMIT_IP_FACTOR", "4"))
+
+    @app.before_request
+    def _limit():
+        if request.method == "OPTIONS":
+            return None
+        cls = route_class(request.path)
+        if cls is None:
+            return None
+
+        if max_queue_ms > 0:
+            delay = queue_delay_ms(request.headers.get("X-Request-Start"))
+            if delay is not None and delay > max_queue_ms:
+                return _retry_response(503, "Server busy", 1)
+
+        if max_inflight > 0:
+            token = store.acquire(max_inflight)
+            if token is None:
+                return _retry_response(503, "Server busy", 1)
+            g._ratelimit_token = token
+
+        limit = limit_for(cls)
+        if limit is None:
+            return None
+        rate, burst = limit
+        user = user_key() if user_key else None
+        ip = client_ip(request, proxy_hops)
+        if user:
+            buckets = [(f"{cls}:ip-users:{ip}", rate * ip_factor, burst * ip_factor),
+                       (f"{cls}:user:{user}", rate, burst)]
+        else:
+            buckets = [(f"{cls}:ip:{ip}", rate, burst)]
+        for key, r, b in buckets:
+            allowed, retry = store.take(key, r, b)
+            if not allowed:
+                return _retry_response(429, "Too many requests", retry)
+        return None
+
+    @app.teardown_request
+    def _release(exc=None):
+        if "_ratelimit_token" in g:
+            store.release(g.pop("_ratelimit_token"))
+
+    app.extensions["ratelimit"] = {"store": store}
+    return store
@@ -0,0 +1,71 @@
+-- Schema the API expects. Idempotent; CI runs it before the test suite.
+
+CREATE TABLE IF NOT EXISTS users (
+    id            UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    username      TEXT NOT NULL,
+    email         TEXT NOT NULL,
+    full_name     TEXT NOT NULL,
+    password_hash TEXT NOT NULL,
+    role          TEXT NOT NULL DEFAULT 'user',
+    cash_balance  NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    CONSTRAINT users_username_key UNIQUE (username),
+    CONSTRAINT users_email_key UNIQUE (email)
+);
+
+CREATE TABLE IF NOT EXISTS stocks (
+    ticker        TEXT NOT NULL,
+    company_name  TEXT NOT NULL,
+    current_price NUMERIC(14, 4) NOT NULL,
+    volume        BIGINT,
+    sector        TEXT,
+    is_listed     BOOLEAN NOT NULL DEFAULT TRUE,
+    created_by    UUID REFERENCES users (id),
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    CONSTRAINT stocks_ticker_key UNIQUE (ticker)
+);
+
+-- Databases created before updated_at existed
+ALTER TABLE stocks ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+-- /market/tickers only ever reads listed rows, in ticker order
+CREATE INDEX IF NOT EXISTS stocks_listed_ticker_idx
+    ON stocks (ticker) WHERE is_listed = TRUE;
+
+-- Each worker's search index polls for rows changed since its last look
+CREATE INDEX IF NOT EXISTS stocks_updated_at_idx
+    ON stocks (updated_at);
+
+-- Tax lots kept by the matching engine shards (matching.py). A lot row is
+-- updated as shares are sold and stays at quantity 0 once closed; shards
+-- reload the open ones, in id order, when they start.
+CREATE TABLE IF NOT EXISTS lots (
+    id          BIGSERIAL PRIMARY KEY,
+    lot_id      TEXT NOT NULL,
+    username    TEXT NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+    ticker      TEXT NOT NULL,
+    quantity    INTEGER NOT NULL CHECK (quantity >= 0),
+    price       NUMERIC(14, 4) NOT NULL,
+    acquired_at TIMESTAMPTZ NOT NULL,
+    CONSTRAINT lots_lot_id_key UNIQUE (lot_id)
+);
+
+CREATE INDEX IF NOT EXISTS lots_open_idx
+    ON lots (id) WHERE quantity > 0;
+
+CREATE TABLE IF NOT EXISTS realized_gains (
+    id          BIGSERIAL PRIMARY KEY,
+    record_id   TEXT NOT NULL,
+    lot_id      TEXT NOT NULL,
+    username    TEXT NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+    ticker      TEXT NOT NULL,
+    quantity    INTEGER NOT NULL,
+    cost_basis  NUMERIC(18, 4) NOT NULL,
+    proceeds    NUMERIC(18, 4) NOT NULL,
+    gain        NUMERIC(18, 4) NOT NULL,
+    term        TEXT NOT NULL CHECK (term IN ('short', 'long')),
+    acquired_at TIMESTAMPTZ NOT NULL,
+    sold_at     TIMESTAMPTZ NOT NULL,
+    CONSTRAINT realized_gains_record_id_key UNIQUE (record_id)
+);
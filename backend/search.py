@@ -0,0 +1,275 @@
+import re, bisect, heapq, threading
+
+# ---- Ticker / company search index ----
+# Everything is kept per worker process in plain dicts and one sorted list:
+#   _tickers   length -> sorted (lower-case ticker, ticker), so ticker prefix
+#              hits come out in ranking order (shorter, then alphabetical)
+#   _terms     sorted (word, ticker, field) for name/sector prefix lookups
+#   _trigrams  trigram -> tickers, for substring matches ("soft" in "microsoft")
+#   _word_docs / _deletes  SymSpell-style one-edit deletes for typo tolerance
+# Updates touch only the rows for one ticker, so admin upserts are cheap.
+# Rows may carry an updated_at version; an upsert older than what the index
+# already holds for that ticker is ignored, so changes can arrive out of order.
+
+SCORE_EXACT_TICKER = 100
+SCORE_TICKER_PREFIX = 80
+SCORE_EXACT_WORD = 60
+SCORE_WORD_PREFIX = 50
+SCORE_SUBSTRING = 30
+SCORE_SECTOR = 20
+SCORE_FUZZY = 10
+
+PREFIX_SCAN_LIMIT = 200
+_WORD = re.compile(r"[a-z0-9]+")
+
+def words(text: str):
+    return _WORD.findall((text or "").lower())
+
+def trigrams(text: str):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def deletes(word: str):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+def within_one_edit(a: str, b: str) -> bool:
+    """Levenshtein distance <= 1 (plus adjacent transposition)."""
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if abs(la - lb) > 1:
+        return False
+    if la == lb:
+        diff = [i for i in range(la) if a[i] != b[i]]
+        if len(diff) == 1:
+            return True
+        return (len(diff) == 2 and diff[1] == diff[0] + 1
+                and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]])
+    if la > lb:
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    return a[i:] == b[i + 1:]
+
+
+class SearchIndex:
+    def __init__(self):
+        self.docs = {}        # ticker -> {"ticker", "company_name", "sector", "current_price"}
+        self._hay = {}        # ticker -> "ticker company name" (lower case)
+        self._words = {}      # ticker -> (company name words, sector words)
+        self._tickers = {}    # ticker length -> sorted (lower-case ticker, ticker)
+        self._terms = []      # sorted (word, ticker, field), field "name" or "sector"
+        self._trigrams = {}   # trigram -> set(ticker)
+        self._word_docs = {}  # word -> set(ticker)
+        self._deletes = {}    # one-char delete of a word -> set(word)
+        self._versions = {}   # ticker -> updated_at of the last row applied (listed or not)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    # -- maintenance --
+    def _entries(self, doc):
+        ticker = doc["ticker"]
+        t = ticker.lower()
+        terms = {(w, ticker, "name") for w in words(doc.get("company_name"))}
+        terms |= {(w, ticker, "sector") for w in words(doc.get("sector"))}
+        fuzzy = {t} | set(words(doc.get("company_name")))
+        return (t, ticker), terms, self._haystack(doc), fuzzy
+
+    @staticmethod
+    def _haystack(doc):
+        return f"{doc['ticker']} {doc.get('company_name') or ''}".lower()
+
+    def upsert(self, row: dict, _bulk: bool = False):
+        """Add/replace one stock; unlisted rows are removed from the index.
+        Returns False if the row is older than the one already applied."""
+        ticker = (row.get("ticker") or "").strip().upper()
+        if not ticker:
+            return False
+        with self._lock:
+            version = row.get("updated_at")
+            if version is not None:
+                seen = self._versions.get(ticker)
+                if seen is not None and version < seen:
+                    return False
+                self._versions[ticker] = version
+            self.remove(ticker)
+            if not row.get("is_listed", True):
+                return True
+            doc = {
+                "ticker": ticker,
+                "company_name": row.get("company_name") or "",
+                "sector": row.get("sector"),
+                "current_price": float(row["current_price"]) if row.get("current_price") is not None else None,
+            }
+            key, terms, hay, fuzzy = self._entries(doc)
+            self.docs[ticker] = doc
+            self._hay[ticker] = hay
+            self._words[ticker] = (words(doc["company_name"]), words(doc["sector"]))
+            by_len = self._tickers.setdefault(len(ticker), [])
+            if _bulk:
+                by_len.append(key)
+                self._terms.extend(terms)
+            else:
+                bisect.insort(by_len, key)
+                for entry in terms:
+                    bisect.insort(self._terms, entry)
+            for tri in trigrams(hay):
+                self._trigrams.setdefault(tri, set()).add(ticker)
+            for w in fuzzy:
+                docs = self._word_docs.setdefault(w, set())
+                if not docs:
+                    for d in deletes(w):
+                        self._deletes.setdefault(d, set()).add(w)
+                docs.add(ticker)
+            return True
+
+    def remove(self, ticker: str):
+        with self._lock:
+            doc = self.docs.pop(ticker, None)
+            if doc is None:
+                return
+            self._hay.pop(ticker, None)
+            self._words.pop(ticker, None)
+            key, terms, hay, fuzzy = self._entries(doc)
+            by_len = self._tickers.get(len(ticker), [])
+            for entries, entry in [(by_len, key)] + [(self._terms, e) for e in terms]:
+                i = bisect.bisect_left(entries, entry)
+                if i < len(entries) and entries[i] == entry:
+                    del entries[i]
+            for tri in trigrams(hay):
+                s = self._trigrams.get(tri)
+                if s is not None:
+                    s.discard(ticker)
+                    if not s:
+                        del self._trigrams[tri]
+            for w in fuzzy:
+                docs = self._word_docs.get(w)
+                if docs is None:
+                    continue
+                docs.discard(ticker)
+                if not docs:
+                    del self._word_docs[w]
+                    for d in deletes(w):
+                        s = self._deletes.get(d)
+                        if s is not None:
+                            s.discard(w)
+                            if not s:
+                                del self._deletes[d]
+
+    def rebuild(self, rows):
+        """Replace the whole index (initial load / periodic refresh)."""
+        fresh = SearchIndex()
+        for row in rows:
+            fresh.upsert(row, _bulk=True)
+        for by_len in fresh._tickers.values():
+            by_len.sort()
+        fresh._terms.sort()
+        with self._lock:
+            self.docs, self._hay, self._words, self._versions = fresh.docs, fresh._hay, fresh._words, fresh._versions
+            self._tickers, self._terms = fresh._tickers, fresh._terms
+            self._trigrams, self._word_docs, self._deletes = fresh._trigrams, fresh._word_docs, fresh._deletes
+
+    # -- lookup --
+    def _match_token(self, tok: str, need: int) -> dict:
+        """Tiered match: prefix first, then substring, then one-typo words.
+        Lower tiers only run while fewer than `need` tickers have matched."""
+        scores = {}
+
+        def hit(ticker, score):
+            if score > scores.get(ticker, 0):
+                scores[ticker] = score
+
+        # Tickers are kept apart from company words, so a crowd of matching
+        # words can't use up the scan, and are walked shortest length first,
+        # so the cap keeps the best-ranked prefix hits rather than A..Z order
+        budget = max(need, PREFIX_SCAN_LIMIT)
+        for length in sorted(n for n in self._tickers if n >= len(tok)):
+            by_len = self._tickers[length]
+            i = bisect.bisect_left(by_len, (tok,))
+            for term, ticker in by_len[i:i + budget]:
+                if not term.startswith(tok):
+                    break
+                hit(ticker, SCORE_EXACT_TICKER if term == tok else SCORE_TICKER_PREFIX)
+                budget -= 1
+            if budget <= 0:
+                break
+
+        i = bisect.bisect_left(self._terms, (tok,))
+        for term, ticker, field in self._terms[i:i + PREFIX_SCAN_LIMIT]:
+            if not term.startswith(tok):
+                break
+            if field == "name":
+                hit(ticker, SCORE_EXACT_WORD if term == tok else SCORE_WORD_PREFIX)
+            else:
+                hit(ticker, SCORE_SECTOR)
+
+        if len(tok) >= 3 and len(scores) < need:
+            postings = sorted((self._trigrams.get(t, set()) for t in trigrams(tok)), key=len)
+            if postings and postings[0]:
+                rest = postings[1:]
+                for ticker in postings[0]:
+                    if ticker in scores or not all(ticker in p for p in rest):
+                        continue
+                    if tok in self._hay[ticker]:
+                        hit(ticker, SCORE_SUBSTRING)
+                        if len(scores) >= need:
+                            break
+
+        if len(tok) >= 4 and len(scores) < need:
+            for w in self._near_words(tok):
+                for ticker in self._word_docs[w]:
+                    hit(ticker, SCORE_FUZZY)
+        return scores
+
+    def _near_words(self, tok: str):
+        near = set(self._deletes.get(tok, ()))
+        for d in deletes(tok):
+            near.add(d)
+            near |= self._deletes.get(d, set())
+        return [w for w in near if w in self._word_docs and within_one_edit(tok, w)]
+
+    def _score_doc(self, tok: str, ticker: str) -> int:
+        """Best score of `tok` against one already-matched ticker."""
+        t = ticker.lower()
+        if t == tok:
+            return SCORE_EXACT_TICKER
+        if t.startswith(tok):
+            return SCORE_TICKER_PREFIX
+        name, sector = self._words[ticker]
+        if tok in name:
+            return SCORE_EXACT_WORD
+        if any(w.startswith(tok) for w in name):
+            return SCORE_WORD_PREFIX
+        if len(tok) >= 3 and tok in self._hay[ticker]:
+            return SCORE_SUBSTRING
+        if any(w.startswith(tok) for w in sector):
+            return SCORE_SECTOR
+        if len(tok) >= 4 and any(within_one_edit(tok, w) for w in [t] + name):
+            return SCORE_FUZZY
+        return 0
+
+    def search(self, q: str, limit: int = 10):
+        """Ranked matches for `q`; every query word must match (prefix,
+        substring or one typo). Ties go to shorter, then alphabetical, tickers.
+
+        The longest word picks the candidates; the other words are only
+        scored against those, so common words like "inc" stay cheap."""
+        toks = sorted(set(words(q)), key=len, reverse=True)
+        if not toks:
+            return []
+        with self._lock:
+            need = limit if len(toks) == 1 else PREFIX_SCAN_LIMIT
+            total = self._match_token(toks[0], need)
+            for tok in toks[1:]:
+                scored = {}
+                for ticker, score in total.items():
+                    extra = self._score_doc(tok, ticker)
+                    if extra:
+                        scored[ticker] = score + extra
+                total = scored
+                if not total:
+                    return []
+            best = heapq.nsmallest(limit, total.items(), key=lambda kv: (-kv[1], len(kv[0]), kv[0]))
+            return [dict(self.docs[t], score=s) for t, s in best]
@@ -0,0 +1,512 @@
+import os, sys, json, time, random, argparse, threading, importlib.util
+import urllib.request, urllib.error
+from collections import defaultdict, Counter
+
+import db
+import matching
+
+# ---- Synthetic trader swarm ----
+# Creates users through db_create_user (directly, or via /auth/register),
+# funds them through db_deposit (directly, or via /cash/deposit), then lets
+# each one run a strategy against the trading and market-data routes while
+# throughput, latency and DB connection usage are recorded. --users takes a
+# ramp ("10,50,200"), so the report shows where the design saturates.
+# In http mode the API must run with ENABLE_TRADING=1.
+#
+# The users are real rows in the users table. Never point this at production;
+# pass --cleanup to delete the run's users (and, by cascade, their lots)
+# through DATABASE_URL / DATABASE_* when it finishes; their orders and lots
+# are purged from the engine shards first.
+#
+#   python swarm.py --mode inprocess --users 10,50,100 --duration 30 --seed-liquidity
+#   python swarm.py --mode http --base-url http://127.0.0.1:8000 --users 20,80
+
+
+# ---- Metrics ----
+def route_key(path: str) -> str:
+    path = path.split("?", 1)[0]
+    if path.startswith("/market/tickers/"):
+        return "/market/tickers/<ticker>"
+    return path
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)   # route -> [ms]
+        self.statuses = defaultdict(Counter)  # route -> {status: count}
+
+    def record(self, route: str, status: int, ms: float):
+        with self._lock:
+            self.latencies[route].append(ms)
+            self.statuses[route][status] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        with self._lock:
+            routes = {}
+            everything = []
+            for route, values in self.latencies.items():
+                values = sorted(values)
+                everything.extend(values)
+                routes[route] = _latency_summary(values, elapsed)
+                routes[route]["statuses"] = dict(self.statuses[route])
+        overall = _latency_summary(sorted(everything), elapsed)
+        errors = sum(c for s in self.statuses.values() for code, c in s.items() if code == 0 or code >= 500)
+        limited = sum(s.get(429, 0) for s in self.statuses.values())
+        return dict(overall, errors=errors, rate_limited=limited, routes=routes)
+
+def _latency_summary(values, elapsed):
+    return {
+        "requests": len(values),
+        "throughput_rps": len(values) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(values, 50),
+        "p90_ms": percentile(values, 90),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else 0.0,
+    }
+
+
+# ---- Transports ----
+def load_app():
+    """Import app2.0.py (not importable by name because of the dot)."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app2.0.py")
+    spec = importlib.util.spec_from_file_location("app2", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class InProcessTransport:
+    """Drives the Flask app through test clients in this process."""
+    name = "inprocess"
+
+    def __init__(self, app_module):
+        self.m = app_module
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body=None, token=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.m.app.test_client()
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        r = client.open(path, method=method, json=body, headers=headers)
+        return r.status_code, r.get_json(silent=True)
+
+    def create_user(self, username: str, password: str):
+        user = self.m.db_create_user(f"Swarm {username}", username, f"{username}@swarm.invalid", password)
+        return {"id": user["id"], "token": self.m.make_token(username)}
+
+    def deposit(self, account: dict, amount: float):
+        return self.m.db_deposit(account["id"], amount)
+
+    def pool_usage(self):
+        return sum(s["in_use"] for s in db.pool_stats().values())
+
+    def delete_users(self, prefix: str):
+        return delete_swarm_users(prefix)
+
+class HttpTransport:
+    """Talks to a running server; register/deposit go through their routes."""
+    name = "http"
+
+    def __init__(self, base_url: str, timeout: float = 10.0, admin_token: str = None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.admin_token = admin_token   # /dbcheck/pool is admin-only
+
+    def request(self, method: str, path: str, body=None, token=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        req.add_header("Content-Type", "application/json")
+        if token:
+            req.add_header("Authorization", f"Bearer {token}")
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as r:
+                return r.status, json.loads(r.read() or b"null")
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.loads(e.read() or b"null")
+            except ValueError:
+                return e.code, None
+
+    def _retrying(self, method, path, body=None, token=None, attempts=10):
+        # Registration bursts trip the auth rate limit; honour Retry-After
+        for _ in range(attempts):
+            status, data = self.request(method, path, body, token)
+            if status != 429:
+                return status, data
+            time.sleep(1)
+        return status, data
+
+    def create_user(self, username: str, password: str):
+        status, data = self._retrying("POST", "/auth/register", {
+            "full_name": f"Swarm {username}", "username": username,
+            "email": f"{username}@swarm.invalid", "password": password,
+        })
+        if status != 201:
+            raise RuntimeError(f"register {username}: {status} {data}")
+        return {"token": data["access_token"]}
+
+    def deposit(self, account: dict, amount: float):
+        status, data = self._retrying("POST", "/cash/deposit", {"amount": amount}, account["token"])
+        if status != 200:
+            raise RuntimeError(f"deposit: {status} {data}")
+        return data["new_balance"]
+
+    def pool_usage(self):
+        if not self.admin_token:
+            return None
+        status, data = self.request("GET", "/dbcheck/pool", token=self.admin_token)
+        if status != 200 or not isinstance(data, dict):
+            return None
+        return sum(s["in_use"] for s in data.values())
+
+    def delete_users(self, prefix: str):
+        # No API route deletes users; go to the database the server uses
+        return delete_swarm_users(prefix)
+
+def delete_swarm_users(prefix: str) -> int:
+    """Delete the users one run registered; returns how many went."""
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM users WHERE username LIKE %s AND email LIKE %s",
+                        (prefix + "%", "%@swarm.invalid"))
+            return cur.rowcount
+
+
+# ---- Agents and strategies ----
+class Agent:
+    def __init__(self, swarm, username: str, account: dict, strategy: str, rng: random.Random):
+        self.swarm = swarm
+        self.username = username
+        self.account = account
+        self.strategy = strategy
+        self.rng = rng
+        self.holdings = defaultdict(int)
+
+    def call(self, method: str, path: str, body=None):
+        start = time.perf_counter()
+        try:
+            status, data = self.swarm.transport.request(method, path, body, self.account["token"])
+        except Exception:
+            status, data = 0, None
+        self.swarm.metrics.record(route_key(path), status, (time.perf_counter() - start) * 1000.0)
+        return status, data
+
+    def order(self, side: str, ticker: str, quantity: int, limit_price=None):
+        status, ack = self.call("POST", f"/trade/{side}", {
+            "ticker": ticker, "quantity": quantity, "limit_price": limit_price,
+        })
+        if status == 200 and ack:
+            self.holdings[ticker] += ack["filled"] if side == "buy" else -ack["filled"]
+            for fill in ack["fills"]:
+                self.swarm.observe_trade(ticker, fill["price"])
+        return status, ack
+
+    def browse(self):
+        ticker = self.rng.choice(self.swarm.tickers)
+        action = self.rng.random()
+        if action < 0.4:
+            self.call("GET", "/market/tickers")
+        elif action < 0.7:
+            self.call("GET", f"/market/tickers/{ticker}")
+        elif action < 0.85:
+            self.call("GET", f"/market/search?q={ticker[:2]}")
+        else:
+            self.call("GET", "/account")
+
+def random_strategy(agent):
+    """Half browsing, half small market orders on a random ticker."""
+    if agent.rng.random() < 0.5:
+        return agent.browse()
+    ticker = agent.rng.choice(agent.swarm.tickers)
+    if agent.holdings[ticker] > 0 and agent.rng.random() < 0.5:
+        agent.order("sell", ticker, agent.rng.randint(1, agent.holdings[ticker]))
+    else:
+        agent.order("buy", ticker, agent.rng.randint(1, 10))
+
+def momentum_strategy(agent):
+    """Buy what just traded up, sell holdings that just traded down."""
+    ticker = agent.rng.choice(agent.swarm.tickers)
+    prev, last = agent.swarm.last_two(ticker)
+    if prev is None or prev == last:
+        return agent.call("GET", f"/market/tickers/{ticker}")
+    if last > prev:
+        agent.order("buy", ticker, agent.rng.randint(1, 5))
+    elif agent.holdings[ticker] > 0:
+        agent.order("sell", ticker, agent.holdings[ticker])
+    else:
+        agent.browse()
+
+def market_maker_strategy(agent, spread: float = 0.01):
+    """Quote a bid under and (with inventory) an ask over the reference price."""
+    ticker = agent.rng.choice(agent.swarm.tickers)
+    ref = agent.swarm.reference_price(ticker)
+    agent.order("buy", ticker, 5, round(ref * (1 - spread), 2))
+    if agent.holdings[ticker] > 0:
+        agent.order("sell", ticker, min(5, agent.holdings[ticker]), round(ref * (1 + spread), 2))
+
+STRATEGIES = {
+    "random": random_strategy,
+    "momentum": momentum_strategy,
+    "market-maker": market_maker_strategy,
+}
+
+def parse_mix(spec: str) -> dict:
+    """"random=0.6,momentum=0.3,market-maker=0.1" -> {name: weight}"""
+    mix = {}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in STRATEGIES:
+            raise ValueError(f"unknown strategy {name!r} (choose from {', '.join(STRATEGIES)})")
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("strategy mix is empty")
+    return mix
+
+
+# ---- DB connection sampling ----
+class DbSampler:
+    """Samples pooled connections in use and server-side backends every `interval`."""
+
+    def __init__(self, transport, interval: float = 0.5):
+        self.transport = transport
+        self.interval = interval
+        self.pooled = []
+        self.server = []
+        self._stop = threading.Event()
+        self._conn = None
+        if db.psycopg2 is not None:
+            try:
+                self._conn = db.psycopg2.connect(connect_timeout=3, **db.connect_kwargs())
+                self._conn.autocommit = True
+            except Exception:
+                self._conn = None
+
+    def _server_backends(self):
+        if self._conn is None:
+            return None
+        try:
+            with self._conn.cursor() as cur:
+                cur.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")
+                return cur.fetchone()[0]
+        except Exception:
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            pooled = self.transport.pool_usage()
+            if pooled is not None:
+                self.pooled.append(pooled)
+            server = self._server_backends()
+            if server is not None:
+                self.server.append(server)
+
+    def start(self):
+        self.pooled, self.server = [], []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+
+        def stats(values):
+            if not values:
+                return None
+            return {"mean": sum(values) / len(values), "max": max(values)}
+        return {"pooled_in_use": stats(self.pooled), "server_backends": stats(self.server)}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+
+# ---- Swarm ----
+class Swarm:
+    def __init__(self, transport, mix: dict, deposit: float = 100000.0, think_ms: float = 0.0,
+                 seed: int = 0, password: str = "swarm-pass-123"):
+        self.transport = transport
+        self.mix = mix
+        self.deposit = deposit
+        self.think_ms = think_ms
+        self.password = password
+        self.rng = random.Random(seed)
+        self.run_id = f"{int(time.time())}{self.rng.randint(0, 999):03d}"
+        self.user_prefix = f"swarm{self.run_id}-"
+        self.metrics = Metrics()
+        self.agents = []
+        self.tickers = []
+        self.prices = {}
+        self._trades = {}
+        self._lock = threading.Lock()
+
+    # market view shared by all agents
+    def load_market(self):
+        status, data = self.transport.request("GET", "/market/tickers")
+        if status != 200 or not data:
+            raise RuntimeError(f"no listed tickers to trade ({status} {data})")
+        self.tickers = [t["ticker"] for t in data]
+        self.prices = {t["ticker"]: float(t["current_price"]) for t in data}
+
+    def observe_trade(self, ticker: str, price: float):
+        with self._lock:
+            prev = self._trades.get(ticker, (None, None))[1]
+            self._trades[ticker] = (prev, price)
+
+    def last_two(self, ticker: str):
+        with self._lock:
+            return self._trades.get(ticker, (None, None))
+
+    def reference_price(self, ticker: str) -> float:
+        last = self.last_two(ticker)[1]
+        return last if last is not None else self.prices.get(ticker, 100.0)
+
+    def seed_liquidity(self, client, shares: int = 1000, spread: float = 0.02):
+        """House (no-user) quotes on every ticker so the first orders can fill."""
+        for ticker in self.tickers:
+            price = self.prices[ticker]
+            client.submit({"ticker": ticker, "side": "sell", "quantity": shares,
+                           "limit_price": round(price * (1 + spread), 2)})
+            client.submit({"ticker": ticker, "side": "buy", "quantity": shares,
+                           "limit_price": round(price * (1 - spread), 2)})
+
+    def grow(self, n: int):
+        """Create and fund users until the swarm has `n` agents."""
+        names, weights = list(self.mix), list(self.mix.values())
+        while len(self.agents) < n:
+            username = f"{self.user_prefix}{len(self.agents)}"
+            account = self.transport.create_user(username, self.password)
+            self.transport.deposit(account, self.deposit)
+            strategy = self.rng.choices(names, weights)[0]
+            self.agents.append(Agent(self, username, account, strategy,
+                                     random.Random(self.rng.random())))
+
+    def teardown(self, engine) -> int:
+        """Delete every user this run created; returns how many were removed.
+
+        The engine shards are purged first so no resting order of theirs can
+        fill, and no lot of theirs be saved, after the rows are gone. If the
+        engines can't be reached the users are left in place."""
+        engine.purge_users([a.username for a in self.agents])
+        removed = self.transport.delete_users(self.user_prefix)
+        self.agents = []
+        return removed
+
+    def _loop(self, agent, stop):
+        act = STRATEGIES[agent.strategy]
+        while not stop.is_set():
+            act(agent)
+            if self.think_ms:
+                stop.wait(self.think_ms / 1000.0)
+
+    def run_step(self, duration: float, sampler=None) -> dict:
+        self.metrics = Metrics()
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._loop, args=(a, stop), daemon=True) for a in self.agents]
+        if sampler:
+            sampler.start()
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        stop.wait(duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        report = self.metrics.summary(elapsed)
+        report["users"] = len(self.agents)
+        report["strategies"] = dict(Counter(a.strategy for a in self.agents))
+        report["db"] = sampler.stop() if sampler else None
+        return report
+
+
+def format_report(r: dict) -> str:
+    dbs = r.get("db") or {}
+    pooled = (dbs.get("pooled_in_use") or {}).get("max")
+    server = (dbs.get("server_backends") or {}).get("max")
+    lines = [
+        f"users={r['users']:<5} rps={r['throughput_rps']:8.1f}  p50={r['p50_ms']:7.1f}ms  "
+        f"p90={r['p90_ms']:7.1f}ms  p99={r['p99_ms']:7.1f}ms  max={r['max_ms']:7.1f}ms  "
+        f"errors={r['errors']}  429={r['rate_limited']}  "
+        f"db pooled(max)={pooled if pooled is not None else '-'}  "
+        f"db backends(max)={server if server is not None else '-'}"
+    ]
+    for route, s in sorted(r["routes"].items()):
+        lines.append(f"    {route:<28} n={s['requests']:<7} rps={s['throughput_rps']:8.1f}  "
+                     f"p50={s['p50_ms']:7.1f}  p99={s['p99_ms']:7.1f}  {s['statuses']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic trader swarm for throughput testing")
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", default="10,50,100", help="ramp of swarm sizes, e.g. 10,50,100")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per ramp step")
+    parser.add_argument("--strategies", default="random=0.6,momentum=0.3,market-maker=0.1")
+    parser.add_argument("--deposit", type=float, default=100000.0)
+    parser.add_argument("--think-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--seed-liquidity", action="store_true",
+                        help="post house quotes through the local engine sockets first")
+    parser.add_argument("--keep-limits", action="store_true",
+                        help="inprocess: keep the API rate limits (off by default)")
+    parser.add_argument("--json", help="also write the reports to this file")
+    parser.add_argument("--admin-token", help="http: admin bearer token for sampling /dbcheck/pool")
+    parser.add_argument("--cleanup", action="store_true",
+                        help="delete the users this run created when it finishes (needs DB access)")
+    args = parser.parse_args(argv)
+
+    if args.mode == "inprocess":
+        if not args.keep_limits:
+            # Rate limits would measure the limiter, not the system
+            for cls in ("AUTH", "CASH", "MARKET", "ADMIN", "TRADE", "PORTFOLIO"):
+                os.environ.setdefault(f"RATE_LIMIT_{cls}", "off")
+            os.environ.setdefault("SHED_MAX_INFLIGHT", "0")
+        os.environ.setdefault("ENABLE_TRADING", "1")
+        transport = InProcessTransport(load_app())
+    else:
+        transport = HttpTransport(args.base_url, admin_token=args.admin_token)
+
+    swarm = Swarm(transport, parse_mix(args.strategies), deposit=args.deposit,
+                  think_ms=args.think_ms, seed=args.seed)
+    swarm.load_market()
+    if args.seed_liquidity:
+        socket_dir, shards = matching.engine_config()
+        swarm.seed_liquidity(matching.EngineClient(socket_dir, shards))
+
+    # Over http, /dbcheck/pool shares the admin rate limit (30/min by default)
+    sampler = DbSampler(transport, interval=0.5 if args.mode == "inprocess" else 2.5)
+    reports = []
+    try:
+        for n in [int(x) for x in args.users.split(",") if x.strip()]:
+            swarm.grow(n)
+            report = swarm.run_step(args.duration, sampler)
+            reports.append(report)
+            print(format_report(report), flush=True)
+    finally:
+        sampler.close()
+        if args.cleanup:
+            socket_dir, shards = matching.engine_config()
+            try:
+                removed = swarm.teardown(matching.EngineClient(socket_dir, shards))
+                print(f"removed {removed} swarm user(s)", file=sys.stderr)
+            except matching.EngineError as e:
+                print(f"cleanup skipped, engines not reachable: {e}", file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+    return reports
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
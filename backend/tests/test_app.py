@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+import db
+import swarm
+
+T0 = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+
+class FakeStocks:
+    """Stands in for db.execute over the stocks table."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def put(self, ticker, name, at, listed=True):
+        self.rows[ticker] = (ticker, name, "Tech", 10.0, listed, at)
+
+    def execute(self, name, params=(), fetch="one", readonly=False, user_key=None):
+        rows = sorted(self.rows.values(), key=lambda r: r[5])
+        if name == "search_universe":
+            return sorted((r for r in rows if r[4]), key=lambda r: r[0])
+        if name == "search_changes":
+            return [r for r in rows if r[5] > params[0]]
+        raise AssertionError(f"unexpected statement {name}")
+
+
+@pytest.fixture
+def stocks(monkeypatch):
+    fake = FakeStocks()
+    monkeypatch.setattr(db, "execute", fake.execute)
+    return fake
+
+
+def _poll(worker):
+    worker._search_refreshing.acquire()
+    worker._apply_search_changes()
+
+
+def test_search_changes_reach_every_worker_without_rebuild(stocks):
+    stocks.put("ACME", "Acme Anvils", T0)
+    one, two = swarm.load_app(), swarm.load_app()
+    for worker in (one, two):
+        assert [r["ticker"] for r in worker.get_search_index().search("acme")] == ["ACME"]
+    index = two.get_search_index()
+
+    stocks.put("ROKT", "Rocket Labs", T0 + timedelta(seconds=5))   # upserted via worker one
+    stocks.put("ACME", "Acme Anvils", T0 + timedelta(seconds=6), listed=False)
+    _poll(two)
+    assert two.get_search_index() is index   # applied in place, not rebuilt
+    assert [r["ticker"] for r in index.search("rocket")] == ["ROKT"]
+    assert index.search("acme") == []
+    assert two._search_version == T0 + timedelta(seconds=6)
+
+
+class StubEngine:
+    """Stands in for matching.EngineClient: answers submit() with a canned ack."""
+
+    def __init__(self, ack=None):
+        self.ack = ack
+        self.orders = []
+
+    def submit(self, order):
+        self.orders.append(order)
+        return self.ack
+
+
+def _ack(status, fills=(), remaining=0):
+    filled = sum(q for _, q in fills)
+    return {"order_id": "0-1", "status": status, "filled": filled, "remaining": remaining,
+            "fills": [{"seq": i, "ticker": "ACME", "price": p, "quantity": q} for i, (p, q) in enumerate(fills)],
+            "realized": []}
+
+
+@pytest.fixture
+def trading(monkeypatch):
+    monkeypatch.setenv("ENABLE_TRADING", "1")
+    monkeypatch.setenv("RATE_LIMIT_STORE", "memory")
+    monkeypatch.setenv("RATE_LIMIT_TRADE", "off")
+    app_module = swarm.load_app()
+    monkeypatch.setattr(app_module, "db_get_user_by_username", lambda username, readonly=False: {
+        "id": "u1", "username": username, "email": "a@example.com", "full_name": "A", "role": "user"})
+    monkeypatch.setattr(db, "execute", lambda name, params=(), **kw: ("ACME", "Acme", 10, 0, "Tech", True))
+    engine = StubEngine()
+    app_module._engine = engine
+    client = app_module.app.test_client()
+    headers = {"Authorization": f"Bearer {app_module.make_token('alice')}"}
+
+    def post(route, **body):
+        r = client.post(f"/trade/{route}", json=dict({"ticker": "acme", "quantity": 3}, **body), headers=headers)
+        return r.status_code, r.get_json()
+    return engine, post
+
+
+def test_trading_is_off_unless_enabled(trading, monkeypatch):
+    engine, post = trading
+    monkeypatch.setenv("ENABLE_TRADING", "")
+    assert post("buy")[0] == 503
+    assert engine.orders == []
+
+
+def test_body_side_must_match_route(trading):
+    engine, post = trading
+    status, data = post("buy", side="sell")
+    assert status == 400 and "buy" in data["detail"]
+    assert engine.orders == []
+
+
+def test_filled_order_returns_fields_the_pages_show(trading):
+    engine, post = trading
+    engine.ack = _ack("filled", fills=[(10.0, 1), (11.0, 2)])
+    status, data = post("sell", side="sell")
+    assert status == 200
+    assert engine.orders[0]["side"] == "sell" and engine.orders[0]["user"] == "alice"
+    assert data["ticker"] == "ACME" and data["side"] == "sell"
+    assert data["quantity"] == 3 and data["price"] == pytest.approx(10.6667)
+    assert data["total_value"] == 32.0 and data["remaining"] == 0
+
+
+def test_market_order_with_nothing_to_match_is_409(trading):
+    engine, post = trading
+    engine.ack = _ack("cancelled", remaining=3)
+    status, data = post("buy")
+    assert status == 409 and "sellers" in data["detail"]
+
+
+def test_resting_limit_order_is_202(trading):
+    engine, post = trading
+    engine.ack = _ack("open", remaining=3)
+    status, data = post("buy", limit_price=9.5)
+    assert status == 202
+    assert data["quantity"] == 0 and data["price"] is None and data["total_value"] == 0
+
+
+def test_engine_rejection_and_outage(trading):
+    engine, post = trading
+
+    def reject(order):
+        raise ValueError("Insufficient shares")
+    engine.submit = reject
+    assert post("sell") == (400, {"detail": "Insufficient shares"})
+
+    def down(order):
+        raise swarm.matching.EngineError("shard 0 unavailable")
+    engine.submit = down
+    assert post("buy")[0] == 503
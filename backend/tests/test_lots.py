@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+import lots
+
+T0 = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+
+def _ledger():
+    ledger = lots.LotLedger()
+    ledger.buy("alice", "ACME", 10, 10.0, acquired_at=T0)                        # L1
+    ledger.buy("alice", "ACME", 10, 20.0, acquired_at=T0 + timedelta(days=10))   # L2
+    ledger.buy("alice", "ACME", 10, 30.0, acquired_at=T0 + timedelta(days=20))   # L3
+    return ledger
+
+
+def test_fifo_consumes_oldest_lots_first():
+    ledger = _ledger()
+    records = ledger.sell("alice", "ACME", 15, 25.0, sold_at=T0 + timedelta(days=30))
+    assert [(r["lot_id"], r["quantity"], r["gain"]) for r in records] == [("L1", 10, 150.0), ("L2", 5, 25.0)]
+    assert [(l["lot_id"], l["quantity"]) for l in ledger.open_lots("alice")] == [("L2", 5), ("L3", 10)]
+
+
+def test_lifo_consumes_newest_lots_first():
+    records = _ledger().sell("alice", "ACME", 12, 25.0, method="lifo")
+    assert [(r["lot_id"], r["quantity"]) for r in records] == [("L3", 10), ("L2", 2)]
+
+
+def test_specific_lots_then_fifo_skips_closed_lot():
+    ledger = _ledger()
+    ledger.sell("alice", "ACME", 10, 25.0, method="specific", lot_ids=["L2"])
+    records = ledger.sell("alice", "ACME", 15, 25.0)
+    assert [r["lot_id"] for r in records] == ["L1", "L3"]
+
+
+def test_insufficient_lots_change_nothing():
+    ledger = _ledger()
+    with pytest.raises(ValueError):
+        ledger.sell("alice", "ACME", 31, 25.0)
+    with pytest.raises(ValueError):
+        ledger.sell("alice", "ACME", 11, 25.0, method="specific", lot_ids=["L1"])
+    assert ledger.open_quantity("alice", "ACME") == 30
+
+
+def test_summary_is_kept_incrementally():
+    ledger = _ledger()
+    ledger.sell("alice", "ACME", 10, 5.0, sold_at=T0 + timedelta(days=400))
+    ledger.sell("alice", "ACME", 10, 25.0, sold_at=T0 + timedelta(days=30))
+    s = ledger.summary("alice")
+    assert s["realized_gain"] == pytest.approx(-50.0 + 50.0)
+    assert s["long_term_gain"] == pytest.approx(-50.0)
+    assert s["short_term_gain"] == pytest.approx(50.0)
+    assert s["positions"] == {"ACME": {"quantity": 10, "cost_basis": 300.0}}
+    assert len(ledger.realized("alice")) == 2
+
+
+def test_merge_summaries():
+    a, b = lots.LotLedger("a"), lots.LotLedger("b")
+    a.buy("alice", "ACME", 5, 10.0)
+    b.buy("alice", "XYZ", 2, 50.0)
+    a.sell("alice", "ACME", 5, 12.0)
+    merged = lots.merge_summaries([a.summary("alice"), b.summary("alice")])
+    assert merged["realized_gain"] == pytest.approx(10.0)
+    assert merged["positions"] == {"XYZ": {"quantity": 2, "cost_basis": 100.0}}
+
+
+def test_changes_reload_into_identical_ledger():
+    stored_lots, stored_realized = {}, []
+
+    def on_change(kind, user, row):
+        if kind == "lot":
+            stored_lots[row["lot_id"]] = (user, row)   # upsert, like the lots table
+        else:
+            stored_realized.append((user, row))
+
+    ledger = lots.LotLedger(on_change=on_change)
+    ledger.buy("alice", "ACME", 10, 10.0, acquired_at=T0)
+    ledger.buy("alice", "ACME", 10, 20.0, acquired_at=T0 + timedelta(days=10))
+    ledger.sell("alice", "ACME", 15, 25.0, sold_at=T0 + timedelta(days=400))
+
+    restored = lots.LotLedger()
+    for user, row in stored_lots.values():
+        if row["quantity"] > 0:
+            restored.load_lot(user, row)
+    for user, record in stored_realized:
+        restored.load_realized(user, record)
+    assert restored.summary("alice") == ledger.summary("alice")
+    assert restored.open_lots("alice") == ledger.open_lots("alice")
+    assert restored.realized("alice") == ledger.realized("alice")
+
+
+def test_open_lots_follow_the_users_positions():
+    ledger = lots.LotLedger()
+    ledger.buy("alice", "ACME", 5, 10.0)
+    ledger.buy("bob", "ACME", 5, 10.0)
+    ledger.buy("alice", "XYZ", 2, 50.0)
+    ledger.sell("alice", "ACME", 5, 12.0)
+    assert [l["ticker"] for l in ledger.open_lots("alice")] == ["XYZ"]
+    ledger.buy("alice", "ACME", 1, 11.0)
+    assert [l["ticker"] for l in ledger.open_lots("alice")] == ["XYZ", "ACME"]
+    ledger.drop_user("alice")
+    assert ledger.open_lots("alice") == [] and len(ledger.open_lots("bob")) == 1
+
+
+def test_loaded_lots_are_kept_in_utc():
+    ledger = lots.LotLedger()
+    ledger.load_lot("alice", {"lot_id": "L9", "ticker": "ACME", "quantity": 1, "price": 1.0,
+                              "acquired_at": "2024-01-02T01:00:00+02:00"})
+    assert ledger.open_lots("alice")[0]["acquired_at"] == "2024-01-01T23:00:00+00:00"
@@ -0,0 +1,244 @@
+import os
+import time
+import itertools
+import pytest
+import db
+import matching
+
+BOOTSTRAP = os.path.join(os.path.dirname(__file__), "..", "scripts", "bootstrap.sql")
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture(autouse=True)
+def engine_key(monkeypatch):
+    monkeypatch.setenv("ENGINE_AUTHKEY", "test-engine-key")
+
+
+def _order(book, side, qty, price=None, user="u"):
+    return book.submit({"order_id": f"o{next(_ids)}", "side": side, "quantity": qty,
+                        "limit_price": price, "user": user})
+
+
+def test_price_time_priority():
+    book = matching.OrderBook("ACME")
+    _order(book, "sell", 5, 101.0, user="late")
+    _order(book, "sell", 5, 100.0, user="first")
+    _order(book, "sell", 5, 100.0, user="second")
+    ack = _order(book, "buy", 12, 101.0, user="buyer")
+    assert ack["status"] == "filled"
+    assert [(f["seller"], f["price"], f["quantity"]) for f in ack["fills"]] == [
+        ("first", 100.0, 5), ("second", 100.0, 5), ("late", 101.0, 2)]
+    assert [f["seq"] for f in ack["fills"]] == [1, 2, 3]
+    assert book.top() == {"ticker": "ACME", "bid": None, "ask": 101.0}
+
+
+def test_limit_rests_and_market_remainder_cancels():
+    book = matching.OrderBook("ACME")
+    assert _order(book, "buy", 10, 99.0)["status"] == "open"
+    ack = _order(book, "sell", 15)
+    assert ack["status"] == "partially_filled"
+    assert ack["filled"] == 10 and ack["remaining"] == 5
+    assert book.top()["bid"] is None
+
+
+@pytest.mark.parametrize("bad", [
+    {"quantity": 1.9}, {"quantity": "nan"}, {"quantity": 0}, {"quantity": True},
+    {"limit_price": "nan"}, {"limit_price": "inf"}, {"limit_price": -1}, {"limit_price": "ten"},
+])
+def test_validate_rejects_non_finite_prices_and_fractional_shares(bad):
+    with pytest.raises(ValueError):
+        matching.validate(dict({"ticker": "ACME", "side": "buy", "quantity": 5}, **bad))
+
+
+def test_validate_accepts_whole_numbers_in_any_form():
+    for qty in (5, 5.0, "5"):
+        assert matching.validate({"ticker": "acme", "side": "buy", "quantity": qty})["quantity"] == 5
+
+
+def test_shard_for_is_stable_and_in_range():
+    assert matching.shard_for("acme", 4) == matching.shard_for(" ACME ", 4)
+    assert all(0 <= matching.shard_for(t, 3) < 3 for t in ["A", "B", "MSFT", "AAPL"])
+
+
+def test_engines_route_and_ack(tmp_path):
+    shards = 2
+    procs = matching.start_engines(shards, str(tmp_path), persist=False)
+    try:
+        client = matching.EngineClient(str(tmp_path), shards)
+        client.wait_ready()
+        tickers = ["AAPL", "MSFT", "TSLA", "NVDA"]
+        for t in tickers:
+            client.submit({"ticker": t, "side": "sell", "quantity": 3, "limit_price": 10})
+        for t in tickers:
+            ack = client.submit({"ticker": t, "side": "buy", "quantity": 3})
+            assert ack["status"] == "filled"
+            assert ack["order_id"].startswith(f"{matching.shard_for(t, shards)}-")
+        with pytest.raises(ValueError):
+            client.submit({"ticker": "AAPL", "side": "hold", "quantity": 1})
+    finally:
+        for p in procs:
+            p.terminate()
+
+
+def test_engine_refuses_missing_key_and_open_socket_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv("ENGINE_AUTHKEY")
+    with pytest.raises(matching.EngineError):
+        matching.start_engines(1, str(tmp_path / "engine"), persist=False)
+    monkeypatch.setenv("ENGINE_AUTHKEY", "test-engine-key")
+    open_dir = tmp_path / "shared"
+    open_dir.mkdir(mode=0o777)
+    open_dir.chmod(0o777)
+    with pytest.raises(matching.EngineError):
+        matching.EngineClient(str(open_dir), 1).ping(0)
+
+
+def test_wrong_key_is_rejected_and_shard_keeps_serving(tmp_path, monkeypatch):
+    procs = matching.start_engines(1, str(tmp_path), persist=False)
+    try:
+        matching.EngineClient(str(tmp_path), 1).wait_ready()
+        monkeypatch.setenv("ENGINE_AUTHKEY", "guess")
+        with pytest.raises(matching.EngineError):
+            matching.EngineClient(str(tmp_path), 1).ping(0)
+        monkeypatch.setenv("ENGINE_AUTHKEY", "test-engine-key")
+        assert matching.EngineClient(str(tmp_path), 1).ping(0) == {"shard": 0}
+    finally:
+        for p in procs:
+            p.terminate()
+
+
+def test_shard_settles_fills_into_lots(tmp_path):
+    procs = matching.start_engines(1, str(tmp_path), persist=False)
+    try:
+        client = matching.EngineClient(str(tmp_path), 1)
+        client.wait_ready()
+        # House liquidity (no user) sells; alice buys twice at different prices
+        client.submit({"ticker": "ACME", "side": "sell", "quantity": 10, "limit_price": 10})
+        client.submit({"ticker": "ACME", "side": "buy", "quantity": 10, "user": "alice"})
+        client.submit({"ticker": "ACME", "side": "sell", "quantity": 10, "limit_price": 20})
+        client.submit({"ticker": "ACME", "side": "buy", "quantity": 10, "limit_price": 20, "user": "alice"})
+        with pytest.raises(ValueError):
+            client.submit({"ticker": "ACME", "side": "sell", "quantity": 21, "limit_price": 1, "user": "alice"})
+
+        client.submit({"ticker": "ACME", "side": "buy", "quantity": 5, "limit_price": 30})
+        ack = client.submit({"ticker": "ACME", "side": "sell", "quantity": 5, "user": "alice", "lot_method": "lifo"})
+        assert [r["gain"] for r in ack["realized"]] == [50.0]
+        # Counterparty usernames never leave the engine
+        assert not any("buyer" in f or "seller" in f for f in ack["fills"])
+
+        summary = client.summary("alice")
+        assert summary["realized_gain"] == 50.0
+        assert summary["positions"]["ACME"]["quantity"] == 15
+
+        # A resting sell reserves its shares
+        assert client.submit({"ticker": "ACME", "side": "sell", "quantity": 15, "limit_price": 100,
+                              "user": "alice"})["status"] == "open"
+        with pytest.raises(ValueError):
+            client.submit({"ticker": "ACME", "side": "sell", "quantity": 1, "limit_price": 100, "user": "alice"})
+    finally:
+        for p in procs:
+            p.terminate()
+
+
+def test_purge_cancels_resting_orders_and_forgets_lots(tmp_path):
+    procs = matching.start_engines(1, str(tmp_path), persist=False)
+    try:
+        client = matching.EngineClient(str(tmp_path), 1)
+        client.wait_ready()
+        client.submit({"ticker": "ACME", "side": "sell", "quantity": 5, "limit_price": 10})
+        client.submit({"ticker": "ACME", "side": "buy", "quantity": 5, "user": "bot"})
+        client.submit({"ticker": "ACME", "side": "buy", "quantity": 3, "limit_price": 9, "user": "bot"})
+        client.submit({"ticker": "ACME", "side": "sell", "quantity": 2, "limit_price": 12, "user": "bot"})
+        assert client.purge_users(["bot"]) == 2
+        assert client.top("ACME") == {"ticker": "ACME", "bid": None, "ask": None}
+        assert client.open_lots("bot") == [] and client.summary("bot")["positions"] == {}
+    finally:
+        for p in procs:
+            p.terminate()
+
+
+def test_realized_merges_shards_in_time_order_across_offsets():
+    client = matching.EngineClient("/nonexistent", 2)
+    client._all = lambda msg: [
+        [{"record_id": "a", "sold_at": "2024-01-02T01:00:00+02:00"}],   # 23:00 UTC the day before
+        [{"record_id": "b", "sold_at": "2024-01-01T23:30:00+00:00"}],
+    ]
+    assert [r["record_id"] for r in client.realized("alice")] == ["a", "b"]
+
+
+def test_save_batch_skips_refused_rows_and_raises_transient(monkeypatch):
+    if db.psycopg2 is None:
+        pytest.skip("psycopg2 not installed")
+    saved = []
+
+    def fake_save(batch):
+        if any(user == "ghost" for _, user, _ in batch):
+            raise db.psycopg2.IntegrityError("violates foreign key constraint")
+        saved.extend(row["lot_id"] for _, _, row in batch)
+
+    monkeypatch.setattr(matching, "save_changes", fake_save)
+    batch = [("lot", "ghost" if i in (2, 5) else "alice", {"lot_id": f"L{i}"}) for i in range(8)]
+    assert matching.save_batch(batch, 0) == 2
+    assert saved == ["L0", "L1", "L3", "L4", "L6", "L7"]
+
+    def down(batch):
+        raise db.psycopg2.OperationalError("server closed the connection")
+
+    monkeypatch.setattr(matching, "save_changes", down)
+    with pytest.raises(db.psycopg2.OperationalError):
+        matching.save_batch(batch, 0)
+
+
+def _bootstrap_db(username):
+    if db.psycopg2 is None:
+        pytest.skip("psycopg2 not installed")
+    try:
+        conn = db.psycopg2.connect(connect_timeout=3, **db.connect_kwargs())
+    except Exception as e:
+        pytest.skip(f"database not reachable: {e}")
+    with conn, conn.cursor() as cur:
+        cur.execute(open(BOOTSTRAP).read())
+        cur.execute("DELETE FROM users WHERE username = %s", (username,))
+        cur.execute("INSERT INTO users (username, email, full_name, password_hash) VALUES (%s, %s, 'Lot Test', 'x')",
+                    (username, f"{username}@example.invalid"))
+    return conn
+
+
+def test_ledger_survives_shard_restart(tmp_path):
+    user = "lot-persist-test"
+    conn = _bootstrap_db(user)
+    try:
+        procs = matching.start_engines(1, str(tmp_path))
+        try:
+            client = matching.EngineClient(str(tmp_path), 1)
+            client.wait_ready()
+            client.submit({"ticker": "ACME", "side": "sell", "quantity": 10, "limit_price": 10})
+            client.submit({"ticker": "ACME", "side": "buy", "quantity": 10, "user": user})
+            client.submit({"ticker": "ACME", "side": "buy", "quantity": 4, "limit_price": 15})
+            client.submit({"ticker": "ACME", "side": "sell", "quantity": 4, "user": user})
+            before = client.summary(user)
+            deadline = time.monotonic() + 5
+            while True:
+                with conn, conn.cursor() as cur:
+                    cur.execute("SELECT count(*) FROM realized_gains WHERE username = %s", (user,))
+                    if cur.fetchone()[0] == 1 or time.monotonic() > deadline:
+                        break
+                time.sleep(0.05)
+        finally:
+            for p in procs:
+                p.terminate()
+                p.join()
+
+        procs = matching.start_engines(1, str(tmp_path))
+        try:
+            client = matching.EngineClient(str(tmp_path), 1)
+            client.wait_ready()
+            assert client.summary(user) == before
+            assert [l["quantity"] for l in client.open_lots(user)] == [6]
+        finally:
+            for p in procs:
+                p.terminate()
+    finally:
+        with conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM users WHERE username = %s", (user,))
+        conn.close()
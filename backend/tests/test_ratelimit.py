@@ -0,0 +1,146 @@
+import pytest
+from flask import Flask, jsonify, request
+import ratelimit
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return ratelimit.MemoryStore()
+    return ratelimit.SqliteStore(str(tmp_path / "buckets.db"))
+
+
+def test_bucket_allows_burst_then_refills(store):
+    rate, burst = 1.0, 3  # 3 requests, then one per second
+    assert all(store.take("k", rate, burst, now=100.0)[0] for _ in range(3))
+    allowed, retry = store.take("k", rate, burst, now=100.0)
+    assert not allowed and retry == pytest.approx(1.0)
+    assert store.take("k", rate, burst, now=101.0)[0]
+
+
+def test_buckets_are_independent(store):
+    assert store.take("a", 1.0, 1, now=0.0)[0]
+    assert not store.take("a", 1.0, 1, now=0.0)[0]
+    assert store.take("b", 1.0, 1, now=0.0)[0]
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "buckets.db")
+    one, two = ratelimit.SqliteStore(path), ratelimit.SqliteStore(path)
+    assert one.take("k", 1.0, 1, now=0.0)[0]
+    assert not two.take("k", 1.0, 1, now=0.0)[0]
+
+
+def test_every_api_prefix_has_a_route_class():
+    for path in ("/auth/login", "/cash/deposit", "/market/search", "/admin/stocks",
+                 "/dbcheck/pool", "/trade/buy", "/portfolio/holdings", "/portfolio/realized"):
+        cls = ratelimit.route_class(path)
+        assert cls is not None and cls in ratelimit.DEFAULT_LIMITS
+
+
+def test_parse_limit():
+    assert ratelimit.parse_limit("30/60") == (0.5, 30)
+    assert ratelimit.parse_limit("off") is None
+
+
+def test_queue_delay_units():
+    assert ratelimit.queue_delay_ms("t=99.5", now=100.0) == pytest.approx(500.0)
+    assert ratelimit.queue_delay_ms("t=99500", now=100.0) is not None
+    assert ratelimit.queue_delay_ms("garbage") is None
+
+
+def _app(monkeypatch, **env):
+    for k, v in env.items():
+        monkeypatch.setenv(k, v)
+    app = Flask(__name__)
+    ratelimit.init_app(app, user_key=lambda: request.headers.get("X-User"), store=ratelimit.MemoryStore())
+
+    @app.route("/cash/deposit", methods=["POST"])
+    def deposit():
+        return jsonify({"ok": True})
+
+    @app.route("/health")
+    def health():
+        return jsonify({"status": "ok"})
+    return app.test_client()
+
+
+def test_route_class_limit_returns_429_with_retry_after(monkeypatch):
+    client = _app(monkeypatch, RATE_LIMIT_CASH="2/60")
+    assert client.post("/cash/deposit").status_code == 200
+    assert client.post("/cash/deposit").status_code == 200
+    r = client.post("/cash/deposit")
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    # unclassified routes are never limited
+    assert client.get("/health").status_code == 200
+
+
+def test_per_user_limit_follows_user_across_ips(monkeypatch):
+    client = _app(monkeypatch, RATE_LIMIT_CASH="1/60")
+    alice = {"X-User": "alice"}
+    assert client.post("/cash/deposit", headers=alice, environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 200
+    assert client.post("/cash/deposit", headers=alice, environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code == 429
+
+
+def test_queue_latency_sheds_with_503(monkeypatch):
+    client = _app(monkeypatch, SHED_QUEUE_MS="100")
+    r = client.post("/cash/deposit", headers={"X-Request-Start": "t=1"})
+    assert r.status_code == 503
+    assert "Retry-After" in r.headers
+
+
+def test_sweep_judges_each_bucket_by_its_own_limit():
+    store = ratelimit.MemoryStore()
+    store.take("slow", 0.01, 10, now=0.0)   # needs 100s to refill
+    store.take("fast", 10.0, 10, now=0.0)
+    store._sweep(1.0)
+    assert "slow" in store._buckets and "fast" not in store._buckets
+
+
+def test_sqlite_store_prunes_full_buckets(tmp_path, monkeypatch):
+    monkeypatch.setattr(ratelimit.SqliteStore, "PRUNE_EVERY", 3)
+    store = ratelimit.SqliteStore(str(tmp_path / "buckets.db"))
+    store.take("a", 1.0, 5, now=0.0)
+    store.take("b", 1.0, 5, now=0.0)
+    store.take("c", 1.0, 5, now=100.0)   # a and b have refilled by now
+    keys = {k for (k,) in store._conn().execute("SELECT key FROM token_buckets")}
+    assert keys == {"c"}
+
+
+def test_inflight_limit_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "buckets.db")
+    one, two = ratelimit.SqliteStore(path), ratelimit.SqliteStore(path)
+    token = one.acquire(1)
+    assert token is not None
+    assert two.acquire(1) is None
+    one.release(token)
+    assert two.acquire(1) is not None
+
+
+def test_client_ip_uses_address_seen_by_trusted_proxy(monkeypatch):
+    client = _app(monkeypatch, RATE_LIMIT_CASH="1/60", RATE_LIMIT_PROXY_HOPS="1")
+    proxy = {"REMOTE_ADDR": "10.0.0.1"}
+    assert client.post("/cash/deposit", environ_base=proxy,
+                       headers={"X-Forwarded-For": "203.0.113.5"}).status_code == 200
+    assert client.post("/cash/deposit", environ_base=proxy,
+                       headers={"X-Forwarded-For": "203.0.113.6"}).status_code == 200
+    # a spoofed left-most entry doesn't buy a fresh bucket
+    r = client.post("/cash/deposit", environ_base=proxy,
+                    headers={"X-Forwarded-For": "1.2.3.4, 203.0.113.5"})
+    assert r.status_code == 429
+
+
+def test_signed_in_users_are_not_limited_by_shared_ip(monkeypatch):
+    client = _app(monkeypatch, RATE_LIMIT_CASH="1/60")
+    same_ip = {"REMOTE_ADDR": "10.0.0.1"}
+    assert client.post("/cash/deposit", headers={"X-User": "alice"}, environ_base=same_ip).status_code == 200
+    assert client.post("/cash/deposit", headers={"X-User": "bob"}, environ_base=same_ip).status_code == 200
+
+
+def test_accounts_from_one_ip_share_a_wider_cap(monkeypatch):
+    client = _app(monkeypatch, RATE_LIMIT_CASH="1/60", RATE_LIMIT_IP_FACTOR="3")
+    same_ip = {"REMOTE_ADDR": "10.0.0.1"}
+    codes = [client.post("/cash/deposit", headers={"X-User": f"sock{i}"}, environ_base=same_ip).status_code
+             for i in range(4)]
+    assert codes == [200, 200, 200, 429]
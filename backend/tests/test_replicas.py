@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+import pytest
+import db
+
+REPLICA = "postgresql://replica.invalid/testdb"
+# Real replica(s), if the environment provides them; the fixture swaps in REPLICA
+LIVE_REPLICAS = os.environ.get("DATABASE_REPLICA_URLS")
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATABASE_REPLICA_URLS", REPLICA)
+    monkeypatch.setenv("DB_PIN_STORE", str(tmp_path / "pins.db"))
+    monkeypatch.setattr(db, "_pin_store", None)
+    db._replica_state.clear()
+    yield
+    db._replica_state.clear()
+    db.close_pool()
+
+
+def test_writes_always_go_to_primary(monkeypatch):
+    monkeypatch.setattr(db, "replica_ok", lambda dsn: True)
+    assert db.route(readonly=False) == db.PRIMARY
+
+
+def test_reads_go_to_healthy_replica(monkeypatch):
+    monkeypatch.setattr(db, "replica_ok", lambda dsn: True)
+    assert db.route(readonly=True, user_key="alice") == REPLICA
+
+
+def test_pinned_user_reads_from_primary(monkeypatch):
+    monkeypatch.setattr(db, "replica_ok", lambda dsn: True)
+    db.pin_primary("alice")
+    assert db.route(readonly=True, user_key="alice") == db.PRIMARY
+    assert db.route(readonly=True, user_key="bob") == REPLICA
+
+
+def test_pin_expires(monkeypatch):
+    monkeypatch.setattr(db, "replica_ok", lambda dsn: True)
+    monkeypatch.setenv("DB_PIN_SECONDS", "0")
+    db.pin_primary("alice")
+    assert db.route(readonly=True, user_key="alice") == REPLICA
+
+
+def test_pins_are_shared_between_workers(tmp_path):
+    # Two stores on one file stand in for two gunicorn workers
+    worker_a, worker_b = db.SqlitePins(str(tmp_path / "shared.db")), db.SqlitePins(str(tmp_path / "shared.db"))
+    worker_a.pin("alice", 2e9)
+    assert worker_b.until("alice") == 2e9
+    assert worker_b.until("bob") == 0.0
+
+
+def test_replica_pools_use_connect_timeout(monkeypatch):
+    seen = {}
+
+    class FakePool:
+        def __init__(self, minconn, maxconn, **kwargs):
+            seen.update(kwargs)
+
+        def closeall(self):
+            pass
+
+    monkeypatch.setattr(db.psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(db, "_pools", {})
+    db.get_pool(REPLICA)
+    assert seen["dsn"] == REPLICA and seen["connect_timeout"] > 0
+
+
+def test_lagging_replica_falls_back_to_primary(monkeypatch):
+    monkeypatch.setattr(db, "replica_lag", lambda dsn: 30.0)
+    assert db.route(readonly=True) == db.PRIMARY
+
+
+def test_down_replica_falls_back_to_primary(monkeypatch):
+    def unreachable(dsn):
+        raise RuntimeError("connection refused")
+    monkeypatch.setattr(db, "replica_lag", unreachable)
+    assert db.route(readonly=True) == db.PRIMARY
+
+
+# ---- Two local instances: DATABASE_URL (primary) + DATABASE_REPLICA_URLS ----
+def _server(target):
+    with db.connection(target) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT inet_server_addr(), inet_server_port()")
+            return cur.fetchone()
+
+
+def test_reads_reach_the_configured_replica(monkeypatch):
+    if not LIVE_REPLICAS or db.psycopg2 is None:
+        pytest.skip("set DATABASE_REPLICA_URLS to a second local Postgres")
+    monkeypatch.setenv("DATABASE_REPLICA_URLS", LIVE_REPLICAS)
+    target = db.route(readonly=True)
+    assert target != db.PRIMARY
+    assert _server(target) != _server(db.PRIMARY)
+
+
+class _Conn:
+    closed = 0
+
+    def __init__(self):
+        self.prepared = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _OnePool:
+    """Stands in for ThreadedConnectionPool with DB_POOL_MAX=1."""
+    maxconn = 1
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.out = 0
+
+    def getconn(self):
+        if self.out:
+            raise db.psycopg2.pool.PoolError("connection pool exhausted")
+        self.out += 1
+        return _Conn()
+
+    def putconn(self, conn, close=False):
+        self.out -= 1
+
+    def closeall(self):
+        pass
+
+
+@pytest.mark.skipif(db.psycopg2 is None, reason="psycopg2 not installed")
+def test_busy_pool_waits_for_a_connection_then_times_out(monkeypatch):
+    monkeypatch.setattr(db.psycopg2.pool, "ThreadedConnectionPool", _OnePool)
+    monkeypatch.setenv("DB_POOL_MAX", "1")
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "2")
+    db.close_pool()
+    held = threading.Event()
+
+    def hold():
+        with db.connection():
+            held.set()
+            time.sleep(0.2)
+
+    t = threading.Thread(target=hold)
+    t.start()
+    held.wait()
+    with db.connection() as conn:   # waits for the other thread instead of PoolError
+        assert isinstance(conn, _Conn)
+    t.join()
+
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "0.05")
+    with db.connection():
+        with pytest.raises(db.psycopg2.pool.PoolError):
+            with db.connection():
+                pass
@@ -0,0 +1,112 @@
+import random
+import string
+import statistics
+import time
+import search
+
+ROWS = [
+    {"ticker": "MSFT", "company_name": "Microsoft Corp", "sector": "Technology", "current_price": 410.0},
+    {"ticker": "MS", "company_name": "Morgan Stanley", "sector": "Financials", "current_price": 95.0},
+    {"ticker": "AAPL", "company_name": "Apple Inc", "sector": "Technology", "current_price": 190.0},
+    {"ticker": "XOM", "company_name": "Exxon Mobil Corp", "sector": "Energy", "current_price": 110.0},
+]
+
+
+def _index():
+    idx = search.SearchIndex()
+    idx.rebuild(ROWS)
+    return idx
+
+
+def _tickers(results):
+    return [r["ticker"] for r in results]
+
+
+def test_exact_ticker_ranks_before_prefix():
+    assert _tickers(_index().search("ms"))[:2] == ["MS", "MSFT"]
+
+
+def test_company_prefix_substring_and_sector():
+    idx = _index()
+    assert _tickers(idx.search("micro")) == ["MSFT"]
+    assert _tickers(idx.search("soft")) == ["MSFT"]
+    assert set(_tickers(idx.search("energy"))) == {"XOM"}
+
+
+def test_typo_tolerance():
+    assert _tickers(_index().search("appel")) == ["AAPL"]
+    assert _tickers(_index().search("exon")) == ["XOM"]
+
+
+def test_every_word_must_match():
+    idx = _index()
+    assert _tickers(idx.search("mobil corp")) == ["XOM"]
+    assert idx.search("apple corp") == []
+
+
+def test_incremental_upsert_and_unlist():
+    idx = _index()
+    idx.upsert({"ticker": "acme", "company_name": "Acme Rockets", "current_price": 5})
+    assert _tickers(idx.search("rock")) == ["ACME"]
+    idx.upsert({"ticker": "ACME", "company_name": "Acme Anvils", "current_price": 6})
+    assert idx.search("rock") == []
+    assert idx.search("anvil")[0]["current_price"] == 6.0
+    idx.upsert({"ticker": "ACME", "company_name": "Acme Anvils", "current_price": 6, "is_listed": False})
+    assert idx.search("acme") == []
+    assert len(idx) == len(ROWS)
+
+
+def test_ticker_prefix_not_crowded_out_by_name_words():
+    rows = [{"ticker": f"Q{i:03d}", "company_name": f"msa{i:03d} Holdings", "current_price": 1}
+            for i in range(300)]
+    rows.append({"ticker": "MSZ", "company_name": "Zeta Corp", "current_price": 1})
+    idx = search.SearchIndex()
+    idx.rebuild(rows)
+    assert "MSZ" in _tickers(idx.search("ms", limit=50))
+    idx.remove("MSZ")
+    idx.upsert(rows[-1])
+    assert _tickers(idx.search("ms", limit=50))[0] == "MSZ"
+
+
+def test_shorter_ticker_prefix_hits_survive_the_scan_cap():
+    rows = [{"ticker": f"AA{a}{b}", "company_name": "Filler", "current_price": 1}
+            for a in "ABCDEFGHIJKLMNOPQRST" for b in "ABCDEFGHIJKLMNO"]   # 300 tickers
+    rows.append({"ticker": "AB", "company_name": "Short One", "current_price": 1})
+    idx = search.SearchIndex()
+    idx.rebuild(rows)
+    assert _tickers(idx.search("a", limit=5))[0] == "AB"
+    idx.remove("AB")
+    idx.upsert(rows[-1])
+    assert _tickers(idx.search("a", limit=5)) == ["AB", "AAAA", "AAAB", "AAAC", "AAAD"]
+
+
+def test_older_versions_are_ignored():
+    idx = search.SearchIndex()
+    idx.upsert({"ticker": "ACME", "company_name": "Acme Anvils", "updated_at": 2})
+    assert idx.upsert({"ticker": "ACME", "company_name": "Acme Rockets", "updated_at": 1}) is False
+    assert _tickers(idx.search("anvil")) == ["ACME"]
+    idx.upsert({"ticker": "ACME", "company_name": "Acme Anvils", "is_listed": False, "updated_at": 3})
+    # an older listed row can't bring an unlisted stock back
+    assert idx.upsert({"ticker": "ACME", "company_name": "Acme Anvils", "updated_at": 2}) is False
+    assert idx.search("acme") == []
+
+
+def test_lookup_latency_on_50k_universe():
+    rng = random.Random(7)
+    vocab = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))) for _ in range(8000)]
+    rows, seen = [], set()
+    while len(rows) < 50000:
+        t = "".join(rng.choices(string.ascii_uppercase, k=rng.randint(1, 5)))
+        if t not in seen:
+            seen.add(t)
+            rows.append({"ticker": t, "company_name": " ".join(rng.sample(vocab, 2)) + " inc",
+                         "sector": "Technology", "current_price": 1})
+    idx = search.SearchIndex()
+    idx.rebuild(rows)
+    queries = ["a", "ab", "abc", vocab[1][:3], vocab[2], vocab[3][:-1] + "q", "tech", vocab[4] + " inc"]
+    timings = []
+    for q in queries * 20:
+        start = time.perf_counter()
+        idx.search(q)
+        timings.append(time.perf_counter() - start)
+    assert statistics.median(timings) < 0.001
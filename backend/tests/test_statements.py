@@ -0,0 +1,73 @@
+import os
+import pytest
+import db
+
+BOOTSTRAP = os.path.join(os.path.dirname(__file__), "..", "scripts", "bootstrap.sql")
+
+# Representative parameters for EXPLAIN EXECUTE of each registered statement
+SAMPLE_PARAMS = {
+    "user_by_username": ("mcamac38",),
+    "cash_balance": ("00000000-0000-0000-0000-000000000000",),
+    "cash_deposit": ("00000000-0000-0000-0000-000000000000", 10),
+    "cash_withdraw": ("00000000-0000-0000-0000-000000000000", 10),
+    "list_tickers": (),
+    "ticker_by_symbol": ("ACME",),
+    "search_universe": (),
+    "search_changes": ("2024-01-01T00:00:00Z",),
+}
+
+
+def _connect():
+    if db.psycopg2 is None:
+        pytest.skip("psycopg2 not installed")
+    try:
+        conn = db.psycopg2.connect(connection_factory=db.PreparedConnection,
+                                   connect_timeout=3, **db.connect_kwargs())
+    except Exception as e:
+        pytest.skip(f"database not reachable: {e}")
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(open(BOOTSTRAP).read())
+    return conn
+
+
+def _index_names(plan):
+    names = set()
+    if "Index Name" in plan:
+        names.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        names |= _index_names(child)
+    return names
+
+
+def test_every_statement_has_sample_params():
+    assert set(SAMPLE_PARAMS) == set(db.STATEMENTS)
+
+
+def test_stats_record_calls_and_average():
+    db.reset_stats()
+    db._record("cash_balance", 2.0)
+    db._record("cash_balance", 4.0)
+    s = db.statement_stats()["cash_balance"]
+    assert s["calls"] == 2
+    assert s["avg_ms"] == 3.0
+    assert s["max_ms"] == 4.0
+    db.reset_stats()
+
+
+@pytest.mark.parametrize("name", sorted(SAMPLE_PARAMS))
+def test_statement_plan_uses_intended_index(name):
+    conn = _connect()
+    try:
+        with conn.cursor() as cur:
+            # Test tables are tiny; make sure the planner picks an index when one applies
+            cur.execute("SET LOCAL enable_seqscan = off")
+            db.prepare(conn, name)
+            params = SAMPLE_PARAMS[name]
+            args = "(%s)" % ", ".join(["%s"] * len(params)) if params else ""
+            cur.execute("EXPLAIN (FORMAT JSON) EXECUTE %s%s" % (name, args), params)
+            plan = cur.fetchone()[0][0]["Plan"]
+        conn.rollback()
+        assert db.STATEMENTS[name].index in _index_names(plan)
+    finally:
+        conn.close()
@@ -0,0 +1,111 @@
+import itertools
+import threading
+import pytest
+import swarm
+
+
+class FakeTransport:
+    """Stands in for the API: two tickers, every market order fills at 10."""
+    name = "fake"
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.deposits = []
+        self.deleted = []
+
+    def request(self, method, path, body=None, token=None):
+        if path == "/market/tickers":
+            return 200, [{"ticker": "ACME", "company_name": "Acme", "current_price": 10.0},
+                         {"ticker": "XYZ", "company_name": "Xyz", "current_price": 20.0}]
+        if path.startswith("/trade/"):
+            qty = body["quantity"]
+            return 200, {"filled": qty, "remaining": 0,
+                         "fills": [{"price": 10.0 + next(self.ids) % 3, "quantity": qty}]}
+        return 200, {}
+
+    def create_user(self, username, password):
+        return {"id": next(self.ids), "token": username}
+
+    def deposit(self, account, amount):
+        with self.lock:
+            self.deposits.append((account["id"], amount))
+        return amount
+
+    def pool_usage(self):
+        return 1
+
+    def delete_users(self, prefix):
+        self.deleted.append(prefix)
+        return 2
+
+
+def test_route_key_and_percentile():
+    assert swarm.route_key("/market/tickers/ACME") == "/market/tickers/<ticker>"
+    assert swarm.route_key("/market/search?q=ac") == "/market/search"
+    assert swarm.percentile([1, 2, 3, 4, 5], 50) == 3
+    assert swarm.percentile([], 99) == 0.0
+
+
+def test_parse_mix():
+    assert swarm.parse_mix("random=2,market-maker=1") == {"random": 2.0, "market-maker": 1.0}
+    with pytest.raises(ValueError):
+        swarm.parse_mix("hodl=1")
+
+
+def test_swarm_ramp_reports_throughput_and_db_usage():
+    transport = FakeTransport()
+    s = swarm.Swarm(transport, swarm.parse_mix("random=1,momentum=1,market-maker=1"), deposit=500.0)
+    s.load_market()
+    reports = []
+    for n in (2, 4):
+        s.grow(n)
+        reports.append(s.run_step(0.2, swarm.DbSampler(transport, interval=0.05)))
+    assert [r["users"] for r in reports] == [2, 4]
+    assert len(transport.deposits) == 4
+    assert all(r["requests"] > 0 and r["throughput_rps"] > 0 for r in reports)
+    assert reports[-1]["db"]["pooled_in_use"]["max"] == 1
+    assert any(route.startswith("/trade/") for route in reports[-1]["routes"])
+    assert swarm.format_report(reports[-1]).startswith("users=4")
+
+
+class FakeEngine:
+    def __init__(self, up=True):
+        self.up = up
+        self.purged = []
+
+    def purge_users(self, users):
+        if not self.up:
+            raise swarm.matching.EngineError("shard 0 unavailable")
+        self.purged.extend(users)
+        return 0
+
+
+def test_teardown_purges_engines_then_deletes_the_runs_users():
+    transport = FakeTransport()
+    s = swarm.Swarm(transport, swarm.parse_mix("random=1"))
+    s.grow(2)
+    assert all(a.username.startswith(s.user_prefix) for a in s.agents)
+    engine = FakeEngine()
+    assert s.teardown(engine) == 2
+    assert len(engine.purged) == 2 and all(u.startswith(s.user_prefix) for u in engine.purged)
+    assert transport.deleted == [s.user_prefix] and s.agents == []
+
+
+def test_teardown_keeps_users_when_engines_unreachable():
+    transport = FakeTransport()
+    s = swarm.Swarm(transport, swarm.parse_mix("random=1"))
+    s.grow(1)
+    with pytest.raises(swarm.matching.EngineError):
+        s.teardown(FakeEngine(up=False))
+    assert transport.deleted == []
+
+
+def test_load_app_serves_health():
+    app_module = swarm.load_app()
+    transport = swarm.InProcessTransport(app_module)
+    status, data = transport.request("GET", "/health")
+    assert status == 200 and data["status"] == "ok"
+    # pool and statement stats are admin-only
+    assert transport.request("GET", "/dbcheck/pool")[0] == 401
+    assert transport.request("GET", "/dbcheck/statements")[0] == 401
@@ -46,6 +46,7 @@ export async function loginUser({ username, password }) {
 
 // Market
 export async function listTickers(){ return http("/market/tickers"); }
+export async function searchTickers(q, limit=10){ return http(`/market/search?q=${encodeURIComponent(q)}&limit=${limit}`); }
 
 // Account & Cash
 export async function getBalance(){ return http("/account", { auth:true }); }
@@ -54,10 +55,14 @@ export async function withdraw(amount){ return http("/cash/withdraw", { method:"
 
 // Trades & Portfolio
 export async function placeOrder({ ticker, side, quantity }){
-  return http("/trade/buy", { method:"POST", auth:true, body:{ ticker, side, quantity: Number(quantity) }});
+  return http(`/trade/${side}`, { method:"POST", auth:true, body:{ ticker, side, quantity: Number(quantity) }});
+}
+export async function sellShares({ ticker, quantity, lot_method="fifo", lot_ids }){
+  return http("/trade/sell", { method:"POST", auth:true, body:{ ticker, quantity: Number(quantity), lot_method, lot_ids }});
 }
 export async function getHoldings(){ return http("/portfolio/holdings", { auth:true }); }
 export async function getTransactions(){ return http("/portfolio/transactions", { auth:true }); }
+export async function getRealizedGains(){ return http("/portfolio/realized", { auth:true }); }
 
 // Guards/helpers
 export function requireAuth(){